@@ -0,0 +1,357 @@
+#!/usr/local/bin/python
+#encoding:utf8
+'''
+Benchmark of the indexing pipeline on deterministic synthetic corpora.
+
+A corpus of Chinese, English or mixed documents is generated from a seed,
+its words drawn from a Zipf distribution over a fixed vocabulary and
+optionally wrapped in HTML. Every scenario (a tokenizer) then times each
+stage on its own: load, filter, tokenize, index, sort/merge, rewrite,
+weight and convert, with its throughput. Stages run in processes of their
+own, so the peak RSS reported is that of the stage; the index, sort/merge
+and rewrite steps share the indexing run and its peak.
+
+Results are written as JSON so runs can be compared across commits:
+
+    python benchmark.py -o new.json --compare old.json
+'''
+from __future__ import with_statement
+import sys
+import os
+import json
+import random
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+from bisect import bisect
+from time import time
+
+STAGES = ['load', 'filter', 'tokenize', 'index', 'sort_merge', 'rewrite', 'weight', 'convert']
+
+def _zh_word(rng):
+    '''a word of 1 to 4 of the first 3000 CJK characters'''
+    return u''.join([unichr(0x4e00 + rng.randint(0, 2999)) for i in xrange(rng.choice((1, 2, 2, 2, 3, 4)))])
+
+def _en_word(rng):
+    '''a lowercase latin word'''
+    return u''.join([rng.choice(u'abcdefghijklmnopqrstuvwxyz') for i in xrange(rng.randint(2, 10))])
+
+def _is_zh(word):
+    return word[0] >= u'一'
+
+def make_vocabulary(size, lang, rng):
+    '''size distinct words, zh, en or mixed (70% Chinese), most frequent first'''
+    words = []
+    seen = set()
+    while len(words) < size:
+        if lang == 'zh' or lang == 'mixed' and rng.random() < 0.7:
+            word = _zh_word(rng)
+        else:
+            word = _en_word(rng)
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+def _sentence(words):
+    '''join words, Chinese ones without spaces, and end the sentence'''
+    parts = [words[0]]
+    for prev, word in zip(words, words[1:]):
+        if not (_is_zh(prev) and _is_zh(word)):
+            parts.append(u' ')
+        parts.append(word)
+    parts.append(_is_zh(words[-1]) and u'。' or u'. ')
+    return u''.join(parts)
+
+def generate_corpus(path, docs=2000, doc_length=300, vocabulary=50000, zipf=1.1,
+        lang='mixed', html=False, seed=0):
+    '''
+    Write a corpus of docs documents in the "doc key\\ttext" format of
+    LocalKVFileLoader. Lengths vary around doc_length words and word ranks
+    follow Zipf's law with exponent zipf; the same parameters always give
+    the same file. Return the size of the corpus in bytes.
+    '''
+    rng = random.Random(seed)
+    words = make_vocabulary(vocabulary, lang, rng)
+    cumulative = []
+    total = 0.0
+    for rank in xrange(1, len(words) + 1):
+        total += rank ** -zipf
+        cumulative.append(total)
+    with open(path, 'w') as fcorpus:
+        for docid in xrange(docs):
+            length = rng.randint(max(doc_length // 2, 1), max(doc_length * 3 // 2, 1))
+            sentences = []
+            while length > 0:
+                size = min(rng.randint(5, 20), length)
+                sentences.append(_sentence([words[bisect(cumulative, rng.random() * total)]
+                    for i in xrange(size)]))
+                length -= size
+            if html:
+                text = u'<html><head><title>%s</title></head><body>%s</body></html>' % (
+                        sentences[0], u''.join([u'<p>%s</p>' % s for s in sentences]))
+            else:
+                text = u''.join(sentences)
+            fcorpus.write("doc%d\t%s\n" % (docid, text.encode('utf8')))
+    return os.path.getsize(path)
+
+def _peak_rss():
+    '''peak resident set size of this process in MB'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024 # bytes there, KB elsewhere
+    return peak / 1024.0
+
+def _stage(seconds, docs, size, peak_rss, **counts):
+    '''metrics of a stage: time, throughput and the peak RSS of the process that ran it'''
+    result = {
+        'seconds': round(seconds, 4),
+        'docs_per_s': round(docs / seconds, 1) if seconds > 0 else None,
+        'mb_per_s': round(size / 1048576.0 / seconds, 3) if seconds > 0 else None,
+        'peak_rss_mb': round(peak_rss, 1),
+    }
+    for name, count in counts.items():
+        result[name] = count
+        result[name + '_per_s'] = round(count / seconds, 1) if seconds > 0 else None
+    return result
+
+def _components(corpus, input_filter_name, tokenizer_name):
+    '''loader, input filter, tokenizer, word filter and stemmer of a scenario'''
+    from pywvtool import load_component
+    return (load_component('loader', 'LocalKVFileLoader', {'src': corpus}),
+            load_component('input_filter', input_filter_name, {}),
+            load_component('tokenizer', tokenizer_name, {}),
+            load_component('word_filter', 'DummyWordFilter', {}),
+            load_component('stemmer', 'DummyStemmer', {}))
+
+def _analysis_stage(corpus, stage, tokenizer_name, input_filter_name):
+    '''
+    Time one of the load, filter and tokenize stages. Documents are streamed
+    through the stages up to it, one at a time, and only the calls of the
+    stage itself are timed. Return (seconds, documents, tokens, seconds of
+    the tokenizer setup, peak RSS).
+    '''
+    from pywvtool import _filtered_spans
+    from instrument import Instrument
+    loader, input_filter, tokenizer = _components(corpus, input_filter_name, tokenizer_name)[:3]
+    setup = 0.0
+    if stage == 'tokenize':
+        start = time()
+        tokenizer.tokenize(u'') # resources loaded on first use, e.g. segmentation dictionaries
+        setup = time() - start
+    instrument = Instrument(sample=1, interval=0)
+    filter_content = instrument.wrap('filter', input_filter.filter)
+    tokenize_counts = instrument.wrap('tokenize', tokenizer.tokenize_counts)
+    docs = tokens = 0
+    loader.open()
+    for uri, content in instrument.wrap_iterator('load', loader.items()):
+        docs += 1
+        if stage == 'load':
+            continue
+        for text, weight in _filtered_spans(filter_content, content):
+            if stage == 'tokenize':
+                tokens += sum([count for (token, count) in tokenize_counts(text)])
+    loader.close()
+    return instrument.summary()['stages'][stage]['seconds'], docs, tokens, setup, _peak_rss()
+
+def _index_stage(corpus, workdir, tokenizer_name, input_filter_name):
+    '''
+    Run index_corpus with every step timed by an Instrument. The index stage
+    is what remains of it once the load, filter, tokenize, sort/merge and
+    rewrite steps inside are taken out. Return ({stage: seconds},
+    vocabulary size, peak RSS).
+    '''
+    from pywvtool import PythonWVTool
+    from instrument import Instrument
+    components = _components(corpus, input_filter_name, tokenizer_name)
+    tool = PythonWVTool('bench', workdir, *(components + ('',)))
+    tool.tokenizer.tokenize(u'') # setup is not indexing
+    tool.instrument = Instrument(sample=1, interval=0)
+    start = time()
+    tool.index_corpus()
+    elapsed = time() - start
+    timers = tool.instrument.summary()['stages']
+    seconds = dict((stage, timers[stage]['seconds'])
+            for stage in ('load', 'filter', 'tokenize', 'sort_merge', 'rewrite'))
+    seconds['index'] = elapsed - sum(seconds.values())
+    return seconds, len(tool.lexicon), _peak_rss()
+
+def _weight_stage(workdir, weighting):
+    '''weight the indexed task, return (seconds, peak RSS)'''
+    from pywvtool import PythonWVTool
+    tool = PythonWVTool('bench', workdir, None, None, None, None, None, '')
+    start = time()
+    tool.create_vector(weighting)
+    return time() - start, _peak_rss()
+
+def _convert_stage(workdir):
+    '''convert the weighted task to svm, return (seconds, bytes of .wv, peak RSS)'''
+    from converter import WVConverter
+    path = os.path.join(workdir, 'bench.%s')
+    start = time()
+    WVConverter(path % 'wv', path % 'svm').convert([('svm', path % 'svm')])
+    return time() - start, os.path.getsize(path % 'wv'), _peak_rss()
+
+def _run_isolated(func, *args):
+    '''func(*args) in a child process, so the peak RSS it sees is its own'''
+    from multiprocessing import Pool
+    pool = Pool(1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.close()
+        pool.join()
+
+def run_scenario(corpus, workdir, tokenizer_name, weighting='TFIDF', input_filter_name='DummyInputFilter'):
+    '''
+    time every stage of indexing corpus with a tokenizer, return {stage:
+    metrics}; each stage runs in a process of its own
+    '''
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.mkdir(workdir)
+    size = os.path.getsize(corpus)
+    results = {}
+    for stage in ('load', 'filter', 'tokenize'):
+        seconds, docs, tokens, setup, peak = _run_isolated(_analysis_stage,
+                corpus, stage, tokenizer_name, input_filter_name)
+        if stage == 'tokenize':
+            results['setup'] = _stage(setup, 0, 0, peak)
+            results[stage] = _stage(seconds, docs, size, peak, tokens=tokens)
+        else:
+            results[stage] = _stage(seconds, docs, size, peak)
+
+    seconds, vocabulary, peak = _run_isolated(_index_stage, corpus, workdir, tokenizer_name, input_filter_name)
+    results['index'] = _stage(seconds['index'], docs, size, peak, tokens=tokens)
+    results['index']['vocabulary'] = vocabulary
+    results['sort_merge'] = _stage(seconds['sort_merge'], docs, size, peak)
+    results['rewrite'] = _stage(seconds['rewrite'], docs, size, peak)
+
+    seconds, peak = _run_isolated(_weight_stage, workdir, weighting)
+    results['weight'] = _stage(seconds, docs, size, peak)
+
+    seconds, wv_size, peak = _run_isolated(_convert_stage, workdir)
+    results['convert'] = _stage(seconds, docs, wv_size, peak)
+    shutil.rmtree(workdir)
+    return results
+
+def _git_commit():
+    '''commit of the working tree, None outside a git checkout'''
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+        output = process.communicate()[0].strip()
+        return output if process.returncode == 0 else None
+    except OSError:
+        return None
+
+def compare(old, new):
+    '''print the stage times of two result sets side by side'''
+    print "%-24s %-10s %10s %10s %8s" % ('scenario', 'stage', 'old s', 'new s', 'ratio')
+    for name in sorted(new['scenarios']):
+        if name not in old['scenarios']:
+            continue
+        for stage in STAGES:
+            before = old['scenarios'][name].get(stage, {}).get('seconds')
+            after = new['scenarios'][name].get(stage, {}).get('seconds')
+            if before is None or after is None:
+                continue
+            print "%-24s %-10s %10.3f %10.3f %8s" % (name, stage, before, after,
+                    "%.2fx" % (after / before) if before > 0 else '-')
+
+def report(results):
+    '''print the metrics of every scenario'''
+    print "%-24s %-10s %10s %10s %10s %10s" % ('scenario', 'stage', 'seconds', 'docs/s', 'MB/s', 'peak MB')
+    for name in sorted(results['scenarios']):
+        for stage in STAGES:
+            metrics = results['scenarios'][name][stage]
+            print "%-24s %-10s %10.3f %10s %10s %10.1f" % (name, stage, metrics['seconds'],
+                    metrics['docs_per_s'], metrics['mb_per_s'], metrics['peak_rss_mb'])
+
+def getopts():
+    '''parse options'''
+    from optparse import OptionParser
+    usage = "benchmark the indexing pipeline on a synthetic corpus"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-o", "--output", dest="output", default="",
+            help="JSON file to write the results to")
+    parser.add_option("", "--compare", dest="compare", default="",
+            help="JSON results of an earlier run to compare with")
+    parser.add_option("", "--scenarios", dest="scenarios", default="CharTokenizer,MMSegTokenizer",
+            help="tokenizers to benchmark separated by commas, default CharTokenizer,MMSegTokenizer")
+    parser.add_option("-w", "--weighting", dest="weighting", default="TFIDF",
+            help="Weighting method, default TFIDF")
+    parser.add_option("", "--corpus", dest="corpus", default="",
+            help="benchmark an existing doc key\\ttext corpus instead of generating one")
+    parser.add_option("", "--docs", dest="docs", type="int", default=2000,
+            help="documents of the generated corpus, default 2000")
+    parser.add_option("", "--doc-length", dest="doc_length", type="int", default=300,
+            help="average words per document, default 300")
+    parser.add_option("", "--vocabulary", dest="vocabulary", type="int", default=50000,
+            help="distinct words of the generated corpus, default 50000")
+    parser.add_option("", "--zipf", dest="zipf", type="float", default=1.1,
+            help="exponent of the Zipf distribution of words, default 1.1")
+    parser.add_option("", "--lang", dest="lang", default="mixed",
+            help="language of the generated corpus: zh, en or mixed, default mixed")
+    parser.add_option("", "--html", action='store_true', dest="html", default=False,
+            help="wrap documents in HTML and filter them with TagRemoverFilter")
+    parser.add_option("", "--seed", dest="seed", type="int", default=0,
+            help="seed of the generated corpus, default 0")
+    parser.add_option("", "--work-dir", dest="work_dir", default="",
+            help="folder for the corpus and task files, a temporary one by default")
+    options = parser.parse_args()[0]
+    if options.lang not in ('zh', 'en', 'mixed'):
+        print "Syntax error, please type -h to see usage."
+        sys.exit(-1)
+    return options
+
+def main():
+    '''main entry'''
+    options = getopts()
+    workdir = options.work_dir or tempfile.mkdtemp(prefix='pywvtool-bench-')
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    try:
+        if options.corpus:
+            corpus = options.corpus
+            params = {'path': os.path.abspath(corpus)}
+        else:
+            corpus = os.path.join(workdir, 'corpus.kv')
+            params = {'docs': options.docs, 'doc_length': options.doc_length,
+                    'vocabulary': options.vocabulary, 'zipf': options.zipf, 'lang': options.lang,
+                    'html': options.html, 'seed': options.seed}
+            start = time()
+            generate_corpus(corpus, **params)
+            print >> sys.stderr, "generated %s in %.1fs" % (corpus, time() - start)
+        params['bytes'] = os.path.getsize(corpus)
+        input_filter = 'TagRemoverFilter' if options.html else 'DummyInputFilter'
+        results = {
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': int(time()),
+            'weighting': options.weighting.upper(),
+            'input_filter': input_filter,
+            'corpus': params,
+            'scenarios': {},
+        }
+        for tokenizer in [name.strip() for name in options.scenarios.split(',') if name.strip()]:
+            print >> sys.stderr, "running %s" % tokenizer
+            results['scenarios'][tokenizer] = run_scenario(corpus, os.path.join(workdir, 'task'),
+                    tokenizer, options.weighting.upper(), input_filter)
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(workdir)
+    report(results)
+    if options.output:
+        with open(options.output, 'w') as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as fold:
+            print
+            compare(json.load(fold), results)
+
+if __name__ == "__main__":
+    main()
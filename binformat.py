@@ -0,0 +1,268 @@
+#!/usr/local/bin/python
+#encoding:utf8
+'''
+Binary columnar storage for .tf, .ii, .wv and .docinfo.
+
+A file holds one sparse table in CSR layout: a column of row keys (docid
+or tokenid), an int64 indptr column and one or two value columns; row i
+owns values indptr[i]:indptr[i+1]. The file starts with a small header
+
+    magic 'PWVB', uint32 version, 8 byte kind, uint32 column count
+
+followed by one directory entry per column
+
+    16 byte name, 4 byte dtype, uint64 offset, uint64 length
+
+and the little-endian columns themselves, 8-byte aligned, so readers can
+memory-map a file and view every column zero-copy with NumPy. A kind may
+also carry extra columns that are not indexed by indptr. NumPy is optional
+and only imported once a table is opened; without it columns are copied
+into array.array instead of mapped.
+'''
+from __future__ import with_statement
+import os
+import sys
+import mmap
+import struct
+import shutil
+from array import array
+from utility import optional_import
+
+MAGIC = 'PWVB'
+VERSION = 1
+_HEADER = struct.Struct('<4sI8sI')
+_ENTRY = struct.Struct('<16s4sQQ')
+_ALIGN = 8
+_TYPECODES = {'<i4': 'i', '<i8': 'l', '<f4': 'f', '|u1': 'B'} # array.array typecodes, LP64
+_SWAP = sys.byteorder != 'little'
+
+# kind -> (key column, [(value column, dtype), ...], [(extra column, dtype), ...])
+LAYOUTS = {
+    'tf': ('docids', [('indices', '<i4'), ('data', '<f4')], []),
+    'wv': ('docids', [('indices', '<i4'), ('data', '<f4')], []),
+    'ii': ('tokenids', [('docids', '<i4')], []),
+    'docinfo': ('docids', [('uris', '|u1')], []),
+    'lexicon': ('hashes', [('tokens', '|u1')], [('table', '<i4')]),
+}
+
+def _columns(kind):
+    '''[(name, dtype), ...] of a kind'''
+    key, values, extras = LAYOUTS[kind]
+    return [(key, '<i4'), ('indptr', '<i8')] + values + extras
+
+def _itemsize(dtype):
+    '''bytes per value of a dtype'''
+    return int(dtype[2:])
+
+def _to_array(values, dtype):
+    '''convert a sequence to an array.array of dtype in file byte order'''
+    if isinstance(values, array) and values.typecode == _TYPECODES[dtype]:
+        data = values
+    else:
+        data = array(_TYPECODES[dtype], values)
+    if _SWAP:
+        data = array(data.typecode, data)
+        data.byteswap()
+    return data
+
+class CSRWriter(object):
+    '''
+    Streaming writer of a binary table. Every column is appended to its own
+    part file, parts are concatenated behind the header on close, so memory
+    stays flat whatever the table size.
+    '''
+    def __init__(self, path, kind):
+        self.path = path
+        self.kind = kind
+        self.columns = _columns(kind)
+        self._dtypes = dict(self.columns)
+        self._numpy = optional_import('numpy')
+        self._parts = {}
+        self._counts = {}
+        for name, dtype in self.columns:
+            self._parts[name] = open(self._part(name), 'wb')
+            self._counts[name] = 0
+        self._nnz = 0
+        self._write('indptr', [0])
+
+    def _part(self, name):
+        '''file name of a column part'''
+        return "%s.%s.part" % (self.path, name)
+
+    def _write(self, name, values):
+        '''append values to a column'''
+        dtype = self._dtypes[name]
+        numpy = self._numpy
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            values = values.astype(dtype)
+            values.tofile(self._parts[name])
+        else:
+            values = _to_array(values, dtype)
+            values.tofile(self._parts[name])
+        self._counts[name] += len(values)
+
+    def add_row(self, key, *values):
+        '''append a row; values are sequences of equal length, one per value column'''
+        self._write(self.columns[0][0], [key])
+        for (name, dtype), column in zip(self.columns[2:], values):
+            self._write(name, column)
+        self._nnz += len(values[0])
+        self._write('indptr', [self._nnz])
+
+    def add_block(self, keys, indptr, *values):
+        '''append a CSR block of NumPy arrays or array.array'''
+        self._write(self.columns[0][0], keys)
+        for (name, dtype), column in zip(self.columns[2:], values):
+            self._write(name, column)
+        shift = self._nnz - indptr[0]
+        numpy = self._numpy
+        if numpy is not None and isinstance(indptr, numpy.ndarray):
+            self._write('indptr', indptr[1:] + shift)
+        elif shift:
+            self._write('indptr', [p + shift for p in indptr[1:]])
+        else:
+            self._write('indptr', indptr[1:])
+        self._nnz += int(indptr[-1] - indptr[0])
+
+    def add_column(self, name, values):
+        '''append values to an extra column'''
+        self._write(name, values)
+
+    def close(self):
+        '''write the file and remove the parts'''
+        for part in self._parts.values():
+            part.close()
+        offset = _HEADER.size + _ENTRY.size * len(self.columns)
+        entries = []
+        for name, dtype in self.columns:
+            offset += -offset % _ALIGN
+            entries.append((name, dtype, offset, self._counts[name]))
+            offset += self._counts[name] * _itemsize(dtype)
+        with open(self.path, 'wb') as fout:
+            fout.write(_HEADER.pack(MAGIC, VERSION, self.kind, len(entries)))
+            for name, dtype, offset, count in entries:
+                fout.write(_ENTRY.pack(name, dtype, offset, count))
+            for name, dtype, offset, count in entries:
+                fout.write('\0' * (offset - fout.tell()))
+                with open(self._part(name), 'rb') as fpart:
+                    shutil.copyfileobj(fpart, fout, 1024 * 1024)
+                os.remove(self._part(name))
+
+class CSRFile(object):
+    '''
+    Memory-mapped reader of a binary table. With NumPy installed every
+    column is a read-only zero-copy view of the mapping.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._numpy = optional_import('numpy')
+        self._fd = open(path, 'rb')
+        self._map = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, kind, count = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise IOError, "%s is not a binary word vector file" % path
+        self.kind = kind.rstrip('\0')
+        self.columns = []
+        self._entries = {}
+        for i in range(count):
+            name, dtype, offset, length = _ENTRY.unpack_from(self._map, _HEADER.size + i * _ENTRY.size)
+            name = name.rstrip('\0')
+            dtype = dtype.rstrip('\0')
+            self.columns.append((name, dtype))
+            self._entries[name] = (dtype, offset, length)
+        self._cache = {}
+        self.keys = self.column(self.columns[0][0])
+        self.indptr = self.column('indptr')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def column(self, name):
+        '''whole column as a NumPy view, or an array.array copy without NumPy'''
+        if name not in self._cache:
+            dtype, offset, length = self._entries[name]
+            numpy = self._numpy
+            if numpy is not None:
+                data = numpy.frombuffer(self._map, dtype=dtype, count=length, offset=offset)
+            else:
+                data = array(_TYPECODES[dtype], self._map[offset:offset + length * _itemsize(dtype)])
+                if _SWAP:
+                    data.byteswap()
+            self._cache[name] = data
+        return self._cache[name]
+
+    def value_columns(self):
+        '''names of the value columns'''
+        return [name for name, dtype in LAYOUTS[self.kind][1]]
+
+    def row(self, i):
+        '''(key, values of column 1, ...) of the i-th row'''
+        start, end = self.indptr[i], self.indptr[i+1]
+        return (self.keys[i],) + tuple([self.column(name)[start:end] for name in self.value_columns()])
+
+    def blocks(self, rows=65536):
+        '''generator of CSR blocks (keys, indptr, values...) with indptr starting at 0'''
+        for begin in xrange(0, len(self), rows):
+            end = min(begin + rows, len(self))
+            start, stop = self.indptr[begin], self.indptr[end]
+            indptr = self.indptr[begin:end+1]
+            if self._numpy is not None:
+                indptr = indptr - start
+            else:
+                indptr = array(indptr.typecode, [p - start for p in indptr])
+            yield (self.keys[begin:end], indptr) + \
+                    tuple([self.column(name)[start:stop] for name in self.value_columns()])
+
+    def close(self):
+        '''release the mapping; columns read before must not be used afterwards'''
+        self._cache = {}
+        self.keys = self.indptr = None
+        self._map.close()
+        self._fd.close()
+
+def _format_value(value):
+    '''format a term frequency, integral ones without decimals'''
+    if value == int(value):
+        return "%d" % value
+    return "%g" % value
+
+def export_text(path_bin, path_text):
+    '''export a binary table to the text format of its kind'''
+    table = CSRFile(path_bin)
+    with open(path_text, 'w') as fout:
+        for i in xrange(len(table)):
+            row = table.row(i)
+            if table.kind == 'tf':
+                fout.write("%d %s\n" % (row[0], " ".join(["%d:%s" % (k, _format_value(v))
+                    for (k, v) in zip(row[1], row[2])])))
+            elif table.kind == 'wv':
+                fout.write("%d %s\n" % (row[0], " ".join(["%d:%f" % (k, v)
+                    for (k, v) in zip(row[1], row[2])])))
+            elif table.kind == 'ii':
+                fout.write("%d,%d,%s\n" % (row[0], len(row[1]), ",".join(["%d" % did for did in row[1]])))
+            elif table.kind == 'docinfo':
+                fout.write("%d,%s\n" % (row[0], row[1].tostring()))
+    table.close()
+
+def getopts():
+    '''parse options'''
+    from optparse import OptionParser
+    usage = "export binary .tf/.ii/.wv/.docinfo files to text"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-i", "--input", dest="input", default="",
+            help="input binary file")
+    parser.add_option("-o", "--output", dest="output", default="",
+            help="output text file")
+    options = parser.parse_args()[0]
+    if not options.input or not options.output:
+        print "-h to see usage"
+        sys.exit(-1)
+    return options.input, options.output
+
+def main():
+    '''main entry'''
+    fninput, fnoutput = getopts()
+    export_text(fninput, fnoutput)
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,359 @@ from __future__ import with_statement
 import sys
 import os
 import codecs
+import mmap
+import shutil
+from bisect import bisect_left
+from array import array
+import binformat
+from lexicon import read_dic
+try:
+    import numpy
+except ImportError:
+    numpy = None # rows are returned as array.array
+
+def _is_binary(filename):
+    '''whether a file is in binformat'''
+    with open(filename, 'rb') as f:
+        return f.read(len(binformat.MAGIC)) == binformat.MAGIC
+
+def _parse_row(line):
+    '''parse "key id:value id:value ..." into (key, ids, values)'''
+    parts = line.split()
+    indices = array('i')
+    values = array('d')
+    for part in parts[1:]:
+        k, v = part.split(':')
+        indices.append(int(k))
+        values.append(float(v))
+    if numpy is not None:
+        indices = numpy.array(indices, dtype=numpy.int32)
+        values = numpy.array(values, dtype=numpy.float64)
+    return int(parts[0]), indices, values
+
+def _sorted_find(keys, key):
+    '''position of key in ascending keys, -1 if absent'''
+    if numpy is not None and isinstance(keys, numpy.ndarray):
+        pos = int(numpy.searchsorted(keys, key))
+    else:
+        pos = bisect_left(keys, key)
+    if pos < len(keys) and keys[pos] == key:
+        return pos
+    return -1
+
+class _TextRows(object):
+    '''
+    Offset index over a memory-mapped text file with one keyed row per
+    line; only the key and start offset of each line are kept in memory.
+    '''
+    def __init__(self, filename, sep):
+        self._fd = open(filename, 'rb')
+        self.keys = array('l')
+        self.offsets = array('l', [0])
+        self._map = None
+        self._keys_sorted = True
+        if os.path.getsize(filename) == 0:
+            return
+        self._map = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        line = self._map.readline()
+        while line:
+            if line.strip():
+                self.keys.append(int(line[:line.find(sep)]))
+                self.offsets.append(self._map.tell())
+            else:
+                self.offsets[-1] = self._map.tell() # skip empty line
+            line = self._map.readline()
+        self._keys_sorted = all(self.keys[i] < self.keys[i+1] for i in xrange(len(self.keys) - 1))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, key):
+        '''row of a key, -1 if absent'''
+        if self._keys_sorted:
+            return _sorted_find(self.keys, key)
+        try:
+            return self.keys.index(key)
+        except ValueError:
+            return -1
+
+    def lines(self, start, stop):
+        '''text of rows [start, stop)'''
+        data = self._map[self.offsets[start]:self.offsets[stop]] if stop > start else ''
+        return [line for line in data.split('\n') if line.strip()]
+
+    def close(self):
+        '''release the mapping'''
+        if self._map is not None:
+            self._map.close()
+        self._fd.close()
+
+class WVReader(object):
+    '''
+    Memory-mapped reader of a word vector file, text .wv or binary .wv.bin.
+    Rows are parsed on demand: random access by docid, row slices, batches
+    of CSR blocks (docids, indptr, indices, data) and, given the matching
+    .ii or .ii.bin, per-feature column access. Only an offset index is held
+    in memory for text files; binary files are viewed zero-copy.
+    '''
+    def __init__(self, fnwv, fnii=None):
+        self._wv = self._open(fnwv, ' ')
+        self._ii = self._open(fnii, ',') if fnii else None
+
+    def _open(self, filename, sep):
+        '''open a binary table or index a text file'''
+        if _is_binary(filename):
+            return binformat.CSRFile(filename)
+        return _TextRows(filename, sep)
+
+    def __len__(self):
+        return len(self._wv)
+
+    def __contains__(self, docid):
+        return self._find(self._wv, docid) != -1
+
+    def __getitem__(self, docid):
+        '''(featureids, weights) of a document'''
+        i = self._find(self._wv, docid)
+        if i == -1:
+            raise KeyError, docid
+        return self.row(i)[1:]
+
+    def _find(self, table, key):
+        '''row of a key in a table'''
+        if isinstance(table, _TextRows):
+            return table.find(key)
+        return _sorted_find(table.keys, key)
+
+    def docids(self):
+        '''docids of all rows, in file order'''
+        return self._wv.keys
+
+    def row(self, i):
+        '''(docid, featureids, weights) of the i-th row'''
+        if isinstance(self._wv, _TextRows):
+            return _parse_row(self._wv.lines(i, i + 1)[0])
+        return self._wv.row(i)
+
+    def block(self, start, stop):
+        '''CSR block (docids, indptr, indices, data) of rows [start, stop)'''
+        stop = min(stop, len(self))
+        if not isinstance(self._wv, _TextRows):
+            indptr = self._wv.indptr
+            begin, end = indptr[start], indptr[stop]
+            offsets = indptr[start:stop+1]
+            if numpy is not None:
+                offsets = offsets - begin
+            else:
+                offsets = array(offsets.typecode, [p - begin for p in offsets])
+            return (self._wv.keys[start:stop], offsets,
+                    self._wv.column('indices')[begin:end], self._wv.column('data')[begin:end])
+        docids = array('l')
+        indptr = array('l', [0])
+        indices = array('i')
+        data = array('d')
+        for line in self._wv.lines(start, stop):
+            docid, ids, values = _parse_row(line)
+            docids.append(docid)
+            indices.extend(array('i', ids))
+            data.extend(array('d', values))
+            indptr.append(len(indices))
+        if numpy is not None:
+            return (numpy.array(docids, dtype=numpy.int64), numpy.array(indptr, dtype=numpy.int64),
+                    numpy.array(indices, dtype=numpy.int32), numpy.array(data, dtype=numpy.float64))
+        return docids, indptr, indices, data
+
+    def batches(self, size=10000):
+        '''generator of CSR blocks of at most size rows'''
+        for start in xrange(0, len(self), size):
+            yield self.block(start, start + size)
+
+    def column(self, featureid):
+        '''(docids, weights) of a feature, looked up through the inverted index'''
+        if self._ii is None:
+            raise ValueError, "column access needs the .ii file"
+        docids = array('l')
+        weights = array('d')
+        i = self._find(self._ii, featureid)
+        if i != -1:
+            if isinstance(self._ii, _TextRows):
+                candidates = [int(did) for did in self._ii.lines(i, i + 1)[0].split(',')[2:]]
+            else:
+                candidates = self._ii.row(i)[1]
+            for docid in candidates:
+                row = self._find(self._wv, docid)
+                if row == -1:
+                    continue
+                ids, values = self.row(row)[1:]
+                pos = _sorted_find(ids, featureid)
+                if pos != -1: # tiny weights may have been dropped
+                    docids.append(int(docid))
+                    weights.append(float(values[pos]))
+        return docids, weights
+
+    def close(self):
+        '''release mapped files'''
+        self._wv.close()
+        if self._ii is not None:
+            self._ii.close()
+
+BUFFER_LINES = 4096 # lines buffered by an output writer before a write
+
+class _FormatWriter(object):
+    '''buffered writer of one output format, fed one .wv row at a time'''
+    needs_pairs = False # whether add() needs (featureid, weight) pairs
+
+    def __init__(self, converter, filename, docid2label):
+        self.converter = converter
+        self.filename = filename
+        self.docid2label = docid2label
+        self._fout = open(filename, 'w')
+        self._buffer = []
+
+    def begin(self):
+        '''write what comes before the rows'''
+        pass
+
+    def add(self, docid, parts, pairs):
+        '''add a row; parts are "featureid:weight" strings'''
+        raise NotImplementedError
+
+    def _emit(self, text):
+        '''buffer output text'''
+        self._buffer.append(text)
+        if len(self._buffer) >= BUFFER_LINES:
+            self.flush()
+
+    def flush(self):
+        '''write out the buffer'''
+        self._fout.writelines(self._buffer)
+        self._buffer = []
+
+    def close(self):
+        '''flush and close the output'''
+        self.flush()
+        self._fout.close()
+
+class SVMWriter(_FormatWriter):
+    '''libsvm format: label featureid:weight ...'''
+    def add(self, docid, parts, pairs):
+        self._emit("%s %s\n" % (self.docid2label.get(docid, 0), ' '.join(parts)))
+
+class TripletWriter(_FormatWriter):
+    '''triplet format: docid,featureid,weight per line'''
+    needs_pairs = True
+
+    def add(self, docid, parts, pairs):
+        self._emit('\n'.join(['%d,%d,%f' % (docid, k, v) for (k, v) in pairs]))
+        self._emit('\n')
+
+class ArffWriter(_FormatWriter):
+    '''
+    weka sparse arff format, attributes in featureid order. Without .dic,
+    e.g. for hashed features, attributes are named f<featureid> and their
+    number is only known after the last row: rows are then streamed to a
+    temporary file, with the largest featureid tracked on the way, and
+    copied behind the header on close.
+    '''
+    def __init__(self, converter, filename, docid2label, fndict):
+        super(ArffWriter, self).__init__(converter, filename, docid2label)
+        self.fndict = fndict
+        self.attribute_count = 0
+        if not fndict:
+            self._fout.close()
+            self._fout = open(filename + '.rows', 'w')
+
+    def _header(self, fout, attributes):
+        '''write relation and attributes, given an iterable of attribute names'''
+        fout.write("@relation '%s'\n\n" % ("%s-%s" % (self.converter.word_vector_filename, self.filename)))
+        for attribute in attributes:
+            fout.write("@attribute %s numeric\n" % attribute)
+        labels = ",".join(["%s" % l for l in set(self.docid2label.values())])
+        fout.write("@attribute __label {%s}\n" % ("0" if not labels else labels))
+        # label index: attribute_count-1+1
+        fout.write("\n@data\n")
+
+    def _dic_attributes(self):
+        '''words of .dic, one per line, line number is the featureid'''
+        encoding = self.converter.default_encoding
+        with codecs.open(self.fndict, 'r', encoding=encoding, errors='strict') as fdict:
+            for line in fdict:
+                self.attribute_count += 1
+                yield line.strip().encode(encoding)
+
+    def begin(self):
+        if self.fndict:
+            self.flush()
+            self._header(self._fout, self._dic_attributes())
+
+    def add(self, docid, parts, pairs):
+        items = [part.replace(":", " ") for part in parts]
+        if self.fndict:
+            items.append("%d %s" % (self.attribute_count, self.docid2label.get(docid, 0)))
+            self._emit("{%s}\n" % ",".join(items))
+            return
+        for part in parts:
+            self.attribute_count = max(self.attribute_count, int(part[:part.find(':')]) + 1)
+        # the label index is not known yet: "label<TAB>items"
+        self._emit("%s\t%s\n" % (self.docid2label.get(docid, 0), ",".join(items)))
+
+    def close(self):
+        super(ArffWriter, self).close()
+        if self.fndict:
+            return
+        count = self.attribute_count
+        with open(self.filename, 'w') as foutput:
+            self._header(foutput, ("f%d" % featureid for featureid in xrange(count)))
+            with open(self.filename + '.rows') as frows:
+                for line in frows:
+                    label, items = line.rstrip('\n').split('\t', 1)
+                    foutput.write("{%s%d %s}\n" % (items + "," if items else "", count, label))
+        os.remove(self.filename + '.rows')
+
+class ClutoWriter(_FormatWriter):
+    '''
+    cluto sparse matrix format: a "rows columns nonzeros" header, then one
+    row per document of 1-based "column weight" pairs. Rows are streamed to
+    a temporary file and copied behind the header on close. .wv has no rows
+    for empty documents, so the docid of every row goes to a cluto row
+    label file, <output>.rlabel.
+    '''
+    needs_pairs = True
+
+    def __init__(self, converter, filename, docid2label, fndict=None):
+        super(ClutoWriter, self).__init__(converter, filename, docid2label)
+        self._fout.close()
+        self._fout = open(filename + '.rows', 'w')
+        self._frlabel = open(filename + '.rlabel', 'w')
+        self.fndict = fndict
+        self.rows = 0
+        self.columns = 0
+        self.nonzeros = 0
+
+    def add(self, docid, parts, pairs):
+        self._emit("%s\n" % " ".join(["%d %f" % (k + 1, v) for (k, v) in pairs]))
+        self._frlabel.write("%d\n" % docid)
+        self.rows += 1
+        self.nonzeros += len(pairs)
+        if pairs:
+            self.columns = max(self.columns, max([k for (k, v) in pairs]) + 1)
+
+    def close(self):
+        super(ClutoWriter, self).close()
+        self._frlabel.close()
+        if self.fndict:
+            with open(self.fndict) as fdict:
+                self.columns = max(self.columns, sum(1 for line in fdict))
+        with open(self.filename, 'w') as foutput:
+            foutput.write("%d %d %d\n" % (self.rows, self.columns, self.nonzeros))
+            with open(self.filename + '.rows') as frows:
+                shutil.copyfileobj(frows, foutput, 1024 * 1024)
+        os.remove(self.filename + '.rows')
 
 class WVConverter(object):
     '''word vector file format converter'''
+    FORMATS = ['svm', 'arff', 'cluto', 'triplet']
+
     def __init__(self, fninput, fnoutput):
         self.word_vector_filename = fninput
         self.output_filename = fnoutput
@@ -28,59 +378,71 @@ class WVConverter(object):
                         docid2label[int(parts[0])] = parts[1]
         return docid2label
 
-    def to_svm(self, fnlabel=None):
-        '''to libsvm format'''
-        docid2label = self._read_label(fnlabel)
-        with open(self.output_filename, 'w') as foutput:
+    def _rows(self):
+        '''generator of (docid, ["featureid:weight", ...]) from .wv or .wv.bin'''
+        if _is_binary(self.word_vector_filename):
+            reader = WVReader(self.word_vector_filename)
+            for docids, indptr, indices, data in reader.batches():
+                for i in xrange(len(docids)):
+                    yield int(docids[i]), ["%d:%f" % (k, v)
+                            for (k, v) in zip(indices[indptr[i]:indptr[i+1]], data[indptr[i]:indptr[i+1]])]
+            reader.close()
+        else:
             with open(self.word_vector_filename, 'r') as finput:
                 for line in finput:
                     parts = line.strip().split()
-                    foutput.write("%s %s\n" %(docid2label.get(int(parts[0]), 0), ' '.join(parts[1:])))
+                    if parts:
+                        yield int(parts[0]), parts[1:]
 
-    def to_triplet(self, fnlabel=None):
+    def convert(self, targets, fndict=None, fnlabel=None):
+        '''
+        Read the word vectors once and write every (format, output filename)
+        in targets at the same time.
+        '''
+        docid2label = self._read_label(fnlabel)
+        writers = []
+        for toformat, fnoutput in targets:
+            if toformat == 'svm':
+                writers.append(SVMWriter(self, fnoutput, docid2label))
+            elif toformat == 'arff':
+                writers.append(ArffWriter(self, fnoutput, docid2label, fndict))
+            elif toformat == 'cluto':
+                writers.append(ClutoWriter(self, fnoutput, docid2label, fndict))
+            elif toformat == 'triplet':
+                writers.append(TripletWriter(self, fnoutput, docid2label))
+            else:
+                raise NotImplementedError, "Not implemented format %s" % toformat
+        needs_pairs = [writer for writer in writers if writer.needs_pairs]
+        for writer in writers:
+            writer.begin()
+        for docid, parts in self._rows():
+            pairs = None
+            if needs_pairs:
+                pairs = [(int(k), float(v)) for (k, v) in [part.split(':') for part in parts]]
+            for writer in writers:
+                writer.add(docid, parts, pairs)
+        for writer in writers:
+            writer.close()
+
+    def to_svm(self, fnlabel=None):
         '''to libsvm format'''
-        with open(self.output_filename, 'w') as foutput:
-            with open(self.word_vector_filename, 'r') as finput:
-                for line in finput:
-                    parts = line.strip().split()
-                    rowid = int(parts[0])
-                    colvals = [(int(item.split(':')[0]), float(item.split(':')[1])) for item in parts[1:]]
-                    foutput.write('\n'.join(['%d,%d,%f' % (rowid, item[0], item[1]) for item in colvals]))
-                    foutput.write('\n')
+        self.convert([('svm', self.output_filename)], fnlabel=fnlabel)
+
+    def to_triplet(self, fnlabel=None):
+        '''to triplet format: docid,featureid,weight'''
+        self.convert([('triplet', self.output_filename)], fnlabel=fnlabel)
+
+    def to_cluto(self, fndict=None):
+        '''to cluto sparse matrix format'''
+        self.convert([('cluto', self.output_filename)], fndict)
 
     def _read_dic(self, fndict):
-        '''read dictionary, word->id'''
-        lexicon = {}
-        with codecs.open(fndict, 'r', encoding=self.default_encoding, errors='strict') as fdict:
-            for index, line in enumerate(fdict):
-                if isinstance(line, str):
-                    line = line.decode(self.default_encoding, 'strict')
-                lexicon[line.strip()] = index
-        return lexicon
-
-    def to_arff(self, fndict, fnlabel=None):
+        '''read dictionary, word->id; a lexicon image next to it is used when fresh'''
+        return dict(read_dic(fndict, self.default_encoding).items())
+
+    def to_arff(self, fndict=None, fnlabel=None):
         '''to weka arff format'''
-        #import pdb; pdb.set_trace()
-        docid2label = self._read_label(fnlabel)
-        lexicon = self._read_dic(fndict)
-        with open(self.output_filename, 'w') as foutput:
-            # write relation name
-            foutput.write("@relation '%s'\n\n" % ("%s-%s" % (self.word_vector_filename, self.output_filename)))
-            # write attributes
-            for word in lexicon:
-                foutput.write("@attribute %s numeric\n" % word.encode(self.default_encoding))
-            labels = ",".join(["%s" % l for l in set(docid2label.values())])
-            foutput.write("@attribute __label {%s}\n" % ("0" if not labels else labels))
-            # label index: len(lexicon)-1+1
-            foutput.write("\n@data\n")
-            # write data
-            with open(self.word_vector_filename, 'r') as finput:
-                for line in finput:
-                    parts = line.strip().split()
-                    foutput.write("{%s,%d %s}\n" 
-                            % (",".join([part.replace(":", " ") for part in parts[1:]]), 
-                                len(lexicon), 
-                                docid2label.get(int(parts[0]), 0)))
+        self.convert([('arff', self.output_filename)], fndict, fnlabel)
 
 def getopts():
     '''parse options'''
@@ -95,7 +457,7 @@ def getopts():
                       help="output file")
     parser.add_option("-f", "--format",
                       dest="format", default="",
-                      help="convert to format: svm/arff/cluto/triplet")
+                      help="convert to format: svm/arff/cluto/triplet, or several separated by commas")
     parser.add_option("-l", "--label",
                       dest="label", default="",
                       help="label file")
@@ -119,17 +481,15 @@ def getopts():
 def main():
     '''main entry'''
     fninput, fnoutput, toformat, fnlabel, fndict, encoding = getopts()
-    toformat = toformat.lower()
+    formats = [f.strip() for f in toformat.lower().split(',') if f.strip()]
     converter = WVConverter(fninput, fnoutput)
     converter.default_encoding = encoding
-    if toformat == 'svm':
-        converter.to_svm(fnlabel)
-    elif toformat == 'arff':
-        converter.to_arff(fndict, fnlabel)
-    elif toformat == 'triplet':
-        converter.to_triplet()
+    if len(formats) == 1:
+        targets = [(formats[0], fnoutput)]
     else:
-        pass
+        # one output per format: output.svm, output.arff, ...
+        targets = [(f, "%s.%s" % (fnoutput, f)) for f in formats]
+    converter.convert(targets, fndict, fnlabel)
 
 if __name__ == "__main__":
     main()
@@ -3,6 +3,8 @@
 '''
 InputFilter interface and some build-in classes.
 '''
+import re
+from htmlentitydefs import name2codepoint
 
 class InputFilter(object):
     def __init__(self, params):
@@ -15,41 +17,201 @@ class DummyInputFilter(InputFilter):
     def filter(self, stream):
         return stream
 
-def _strip_tags(s):
-    intag = [False]
+# start of one markup token: comment, doctype or other declaration,
+# processing instruction, or start/end tag; where it ends is found by scanning
+_MARKUP = re.compile(r'<(?:!--|[!?]|(/?)([a-zA-Z][-\w:.]*))')
+_SPACES = re.compile(r'\s*')
+_ENTITY = re.compile(r'&(?:#([0-9]+)|#[xX]([0-9a-fA-F]+)|([a-zA-Z][a-zA-Z0-9]*));')
+# elements whose content is not text, and where it ends
+_SKIPPED = {
+    'script': re.compile(r'</script\s*>', re.I),
+    'style': re.compile(r'</style\s*>', re.I),
+    'head': re.compile(r'</head\s*>|<body[\s>]', re.I),
+}
+# tags that break text, replaced by a newline so words do not run together
+_BLOCKS = frozenset(['address', 'article', 'aside', 'blockquote', 'body', 'br', 'dd', 'div',
+    'dl', 'dt', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'html',
+    'li', 'nav', 'ol', 'option', 'p', 'pre', 'section', 'table', 'td', 'th', 'title', 'tr', 'ul'])
 
-    def chk(c):
-        if intag[0]:
-            intag[0] = (c != '&gt;')
-            return False
-        elif c == '&lt;':
-            intag[0] = True
-            return False
-        return True
+def _unichr(codepoint):
+    '''unicode character of a code point, also beyond the BMP on narrow builds'''
+    try:
+        return unichr(codepoint)
+    except ValueError:
+        return ('\\U%08x' % codepoint).decode('unicode-escape')
 
-    return ''.join(c for c in s if chk(c))
+def _decode_entity(match):
+    '''replacement of one character or named entity reference'''
+    decimal, hexadecimal, name = match.groups()
+    try:
+        if decimal:
+            return _unichr(int(decimal))
+        elif hexadecimal:
+            return _unichr(int(hexadecimal, 16))
+        elif name in name2codepoint:
+            return unichr(name2codepoint[name])
+    except (ValueError, OverflowError, UnicodeError):
+        pass # not a valid code point
+    return match.group(0)
+
+class _NextIndex(object):
+    '''
+    text.find(sub, pos) for a scan moving forward: the last answer is reused
+    until pos passes it, so a sub missing from the rest of the text is
+    searched for once rather than once per candidate tag.
+    '''
+    def __init__(self, text, sub):
+        self.text = text
+        self.sub = sub
+        self.start = self.found = len(text) + 1
+
+    def __call__(self, pos):
+        if pos < self.start or 0 <= self.found < pos:
+            self.start = pos
+            self.found = self.text.find(self.sub, pos)
+        return self.found
+
+def _tag_end(html, pos, next_gt, next_quote):
+    '''
+    Position after the > ending a tag whose attributes start at pos, -1 if
+    there is none. Quotes delimit attribute values only right after =, as
+    in title="a > b"; a value whose quote is never closed ends at the next >.
+    '''
+    while True:
+        gt = next_gt(pos)
+        if gt < 0:
+            return -1
+        equals = html.find('=', pos, gt)
+        if equals < 0:
+            return gt + 1
+        pos = _SPACES.match(html, equals + 1, gt).end()
+        quote = html[pos]
+        if quote == '"' or quote == "'":
+            close = next_quote[quote](pos + 1)
+            if close < 0:
+                return gt + 1
+            pos = close + 1
+
+def _html_spans(html, weights=None):
+    '''
+    Generator of (raw text, weight) spans of the visible text of an HTML
+    page, scanned in a single pass without building a tree. Comments,
+    declarations, script, style and head are skipped and block level tags
+    become newlines. Text inside an element listed in weights, a dict of
+    tag -> weight, gets the largest weight of its open elements, other text
+    weight 1; consecutive spans of equal weight are merged. A weighted
+    title is kept even though it is in the head.
+    '''
+    weights = weights or {}
+    keep_title = 'title' in weights
+    in_head = False # inside a head scanned for its title
+    opened = [] # weights of the open weighted elements
+    names = [] # their tags
+    texts = []
+    weight = 1
+    unended = set() # skipped elements with no end in the rest of the page
+    next_gt = _NextIndex(html, '>')
+    next_quote = {'"': _NextIndex(html, '"'), "'": _NextIndex(html, "'")}
+    pos = 0 # end of the last markup token
+    scan = 0 # where to look for the next one
+    size = len(html)
+    while scan < size:
+        match = _MARKUP.search(html, scan)
+        if match is None:
+            break
+        start = match.start()
+        name = match.group(2)
+        if name is not None:
+            end = _tag_end(html, match.end(), next_gt, next_quote)
+        elif match.end() - start == 4: # comment, an unclosed one runs to the end
+            end = html.find('-->', start + 4)
+            end = end + 3 if end >= 0 else size
+        else:
+            end = next_gt(start)
+            end = end + 1 if end >= 0 else -1
+        if end < 0:
+            scan = start + 1 # no markup, the < is text
+            continue
+        if start > pos and (not in_head or 'title' in names):
+            texts.append(html[pos:start])
+        pos = scan = end
+        if name is None:
+            continue # comment, declaration or processing instruction
+        name = name.lower()
+        attributes = html[match.end():end - 1]
+        closing = match.group(1)
+        if name in _BLOCKS:
+            texts.append(u'\n')
+        changed = False
+        if names and name in _BLOCKS and name not in ('br', 'hr'):
+            # a block ends the inline weighted elements left open, e.g. <a> without </a>
+            kept = [i for i in range(len(names)) if names[i] in _BLOCKS]
+            if len(kept) < len(names):
+                names = [names[i] for i in kept]
+                opened = [opened[i] for i in kept]
+                changed = True
+        if name in weights and not attributes.rstrip().endswith('/'):
+            if name in names: # end tag, or an unclosed element of the same tag
+                index = len(names) - 1 - names[::-1].index(name)
+                del names[index:], opened[index:]
+            if not closing:
+                names.append(name)
+                opened.append(weights[name])
+            changed = True
+        if changed:
+            new_weight = max(opened) if opened else 1
+            if new_weight != weight:
+                if texts:
+                    yield u''.join(texts), weight
+                texts = []
+                weight = new_weight
+        if in_head and (name == 'head' and closing or name == 'body'):
+            in_head = False
+        elif not closing and name in _SKIPPED and not attributes.rstrip().endswith('/'):
+            if name == 'head' and keep_title:
+                in_head = True
+                continue
+            end = None if name in unended else _SKIPPED[name].search(html, pos)
+            if end is not None:
+                pos = scan = end.start()
+            elif name != 'head': # a head without </head> nor <body> is kept
+                pos = size
+                break # unclosed script or style runs to the end
+            else:
+                unended.add(name)
+    if pos < size and not in_head:
+        texts.append(html[pos:])
+    if texts:
+        yield u''.join(texts), weight
+
+def html_to_text(html):
+    '''
+    Extract the visible text of an HTML page in a single pass over it, no
+    tree is built. Comments, declarations, script, style and head are
+    skipped, block level tags become newlines and entities are decoded.
+    '''
+    return _ENTITY.sub(_decode_entity, u''.join([text for (text, weight) in _html_spans(html)]))
 
 class TagRemoverFilter(InputFilter):
     '''remove html/xml tags'''
     def filter(self, stream):
-        try:
-            from ab.util.BeautifulSoup import BeautifulSoup
-            def visible(element): 
-                import re
-                if element.parent.name in ['style', 'script', '[document]', 'head']: 
-                    return False 
-                elif re.match('<!--.*-->', str(element)): 
-                    return False 
-                else:
-                    return True 
-            soup = BeautifulSoup(stream)
-            texts = soup.findAll(text=True)
-            visible_texts = filter(visible, texts)
-            return ''.join(visible_texts)
-        except ImportError:
-            return _strip_tags(stream)
+        return html_to_text(stream)
 
 class TagWeightingFilter(InputFilter):
-    def filter(self, stream):
-        pass
+    '''
+    Extract the text of an HTML page as (text, weight) spans, so terms in
+    titles, headings and anchors count more than body text. Weights of tags
+    are given as params, e.g. title=3&h1=2&a=1.5, replacing the defaults.
+    '''
+    DEFAULT_WEIGHTS = {'title': 3, 'h1': 2, 'h2': 1.5, 'a': 1.5}
 
+    def __init__(self, params):
+        super(TagWeightingFilter, self).__init__(params)
+        if params:
+            self.weights = dict((tag.lower(), float(weight)) for (tag, weight) in params.items())
+        else:
+            self.weights = dict(self.DEFAULT_WEIGHTS)
+
+    def filter(self, stream):
+        return [(_ENTITY.sub(_decode_entity, text), weight)
+                for (text, weight) in _html_spans(stream, self.weights)]
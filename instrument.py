@@ -0,0 +1,264 @@
+#!/usr/local/bin/python
+#encoding:utf8
+'''
+Instrumentation of an indexing run: sampled timers around the pipeline
+components, whole-step timers around post-processing, counters, periodic
+progress lines, also during long steps, and a final JSON summary. An
+optional cProfile hook covers one in every profile_sample documents.
+
+NullInstrument has the same interface and does nothing, so callers need
+no checks when instrumentation is off.
+'''
+from __future__ import with_statement
+import sys
+import os
+import json
+import resource
+import threading
+from time import time
+
+def _rss():
+    '''(current, peak) resident set size of this process in MB'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024 # bytes there, KB elsewhere
+    peak /= 1024.0
+    try:
+        with open('/proc/self/statm') as fstatm:
+            current = int(fstatm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576.0
+    except (IOError, OSError, ValueError):
+        current = peak
+    return current, peak
+
+class _StepTimer(object):
+    '''context manager adding the time of a step to a timer, and marking it as the current step'''
+    def __init__(self, instrument, name):
+        self._instrument = instrument
+        self._name = name
+        self._timer = instrument._timer(name)
+
+    def __enter__(self):
+        self._start = time()
+        self._outer = self._instrument.step
+        self._instrument.step = (self._name, self._start)
+
+    def __exit__(self, *exc_info):
+        timer = self._timer
+        timer[0] += 1
+        timer[1] += 1
+        timer[2] += time() - self._start
+        self._instrument.step = self._outer
+
+class _NullTimer(object):
+    '''context manager that times nothing'''
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+class NullInstrument(object):
+    '''instrumentation turned off'''
+    def wrap(self, name, func):
+        return func
+
+    def wrap_iterator(self, name, iterable):
+        return iterable
+
+    def timed(self, name):
+        return _NullTimer()
+
+    def count(self, name, value=1):
+        pass
+
+    def gauge(self, name, func):
+        pass
+
+    def document(self, word_freq):
+        pass
+
+    def close(self):
+        pass
+
+    def summary(self):
+        return {}
+
+    def dump(self, path):
+        pass
+
+class Instrument(NullInstrument):
+    '''
+    Timers and counters of an indexing run. Wrapped calls are timed one in
+    sample times and their total is estimated from the timed ones, so the
+    cost stays one counter increment for the others. Every interval seconds
+    a progress line goes to stream with the document and token rates since
+    the previous line, the gauges (e.g. lexicon size), bytes written to
+    the task files and RSS. Lines come from the document loop, and from
+    a ticker thread when none came for an interval, e.g. during a long
+    sort_merge or rewrite; they then name the step and its time so far.
+    '''
+    def __init__(self, sample=100, interval=10.0, profile_sample=0, stream=None):
+        self.sample = max(sample, 1) # one in sample calls of a wrapped function is timed
+        self.interval = interval # seconds between progress lines, 0 for none
+        self.profile_sample = profile_sample # one in profile_sample documents is profiled, 0 for none
+        self.stream = stream or sys.stderr
+        self.timers = {} # name -> [calls, timed calls, seconds of the timed calls]
+        self.counters = {'documents': 0, 'tokens': 0, 'bytes_written': 0}
+        self.gauges = {} # name -> function returning the current value
+        self.step = None # (name, start) of the timed step running
+        self.profiler = None
+        self._profiling = False
+        self._start = time()
+        self._last = (self._start, 0, 0) # time, documents and tokens of the last progress line
+        self._lock = threading.Lock() # progress lines come from two threads
+        self._stopped = threading.Event()
+        self._ticker = None
+        if profile_sample:
+            import cProfile
+            self.profiler = cProfile.Profile()
+        if interval:
+            self._ticker = threading.Thread(target=self._tick)
+            self._ticker.setDaemon(True)
+            self._ticker.start()
+
+    def _timer(self, name):
+        return self.timers.setdefault(name, [0, 0, 0.0])
+
+    def wrap(self, name, func):
+        '''func timed one in sample calls under name'''
+        timer = self._timer(name)
+        sample = self.sample
+        def timed(*args):
+            timer[0] += 1
+            if timer[0] % sample:
+                return func(*args)
+            start = time()
+            try:
+                return func(*args)
+            finally:
+                timer[1] += 1
+                timer[2] += time() - start
+        return timed
+
+    def wrap_iterator(self, name, iterable):
+        '''iterable whose next() is timed one in sample times under name'''
+        timer = self._timer(name)
+        sample = self.sample
+        iterator = iter(iterable)
+        while True:
+            timer[0] += 1
+            if timer[0] % sample:
+                item = iterator.next()
+            else:
+                start = time()
+                try:
+                    item = iterator.next()
+                finally:
+                    timer[1] += 1
+                    timer[2] += time() - start
+            yield item
+
+    def timed(self, name):
+        '''context manager timing a whole step, e.g. with instrument.timed('sort_merge'):'''
+        return _StepTimer(self, name)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, func):
+        '''report func() as name in progress lines and the summary'''
+        self.gauges[name] = func
+
+    def document(self, word_freq):
+        '''
+        mark the end of a document given its {tokenid: freq}; also moves the
+        profiler on to the next document if that one is sampled
+        '''
+        counters = self.counters
+        counters['documents'] += 1
+        counters['tokens'] += sum([abs(freq) for freq in word_freq.itervalues()])
+        if self.profiler is not None:
+            if self._profiling:
+                self.profiler.disable()
+                self._profiling = False
+            if counters['documents'] % self.profile_sample == 0:
+                self.profiler.enable()
+                self._profiling = True
+        if self.interval and counters['documents'] & 63 == 0:
+            if time() - self._last[0] >= self.interval:
+                self._progress()
+
+    def _tick(self):
+        '''ticker thread: a progress line whenever none was written for an interval'''
+        while True:
+            self._stopped.wait(self.interval)
+            if self._stopped.isSet():
+                break
+            if time() - self._last[0] >= self.interval:
+                self._progress()
+
+    def _progress(self):
+        '''write a progress line, unless the other thread just wrote one'''
+        with self._lock:
+            now = time()
+            last_time, last_documents, last_tokens = self._last
+            counters = self.counters
+            elapsed = now - last_time
+            if elapsed < self.interval:
+                return
+            current, peak = _rss()
+            parts = ["[%8.1fs] %d docs %.1f docs/s %d tokens %.1f tokens/s" % (now - self._start,
+                    counters['documents'], (counters['documents'] - last_documents) / elapsed,
+                    counters['tokens'], (counters['tokens'] - last_tokens) / elapsed)]
+            step = self.step
+            if step is not None:
+                parts.append("in %s for %.1fs" % (step[0], now - step[1]))
+            for name in sorted(self.gauges):
+                parts.append("%s %s" % (name, self.gauges[name]()))
+            parts.append("written %.1fMB rss %.1fMB" % (counters['bytes_written'] / 1048576.0, current))
+            print >> self.stream, ' '.join(parts)
+            self._last = (now, counters['documents'], counters['tokens'])
+
+    def close(self):
+        '''stop profiling and the ticker thread'''
+        if self._profiling:
+            self.profiler.disable()
+            self._profiling = False
+        if self._ticker is not None:
+            self._stopped.set()
+            self._ticker.join()
+            self._ticker = None
+
+    def summary(self):
+        '''dict of all timers, counters, rates, gauges and memory'''
+        elapsed = time() - self._start
+        current, peak = _rss()
+        stages = {}
+        for name, (calls, timed, seconds) in self.timers.items():
+            stages[name] = {
+                'calls': calls,
+                'timed_calls': timed,
+                'seconds': round(seconds * calls / timed if timed else 0.0, 4),
+            }
+        summary = {
+            'elapsed': round(elapsed, 3),
+            'counters': dict(self.counters),
+            'rates': {
+                'documents_per_s': round(self.counters['documents'] / elapsed, 1) if elapsed else None,
+                'tokens_per_s': round(self.counters['tokens'] / elapsed, 1) if elapsed else None,
+            },
+            'stages': stages,
+            'gauges': dict((name, func()) for (name, func) in self.gauges.items()),
+            'rss_mb': round(current, 1),
+            'peak_rss_mb': round(peak, 1),
+            'sample': self.sample,
+        }
+        return summary
+
+    def dump(self, path):
+        '''write the summary as JSON to path, and the profile next to it as .prof'''
+        self.close()
+        with open(path, 'w') as fstats:
+            json.dump(self.summary(), fstats, indent=2, sort_keys=True)
+        if self.profiler is not None:
+            self.profiler.dump_stats(os.path.splitext(path)[0] + '.prof')
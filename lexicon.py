@@ -0,0 +1,253 @@
+#!/usr/local/bin/python
+#encoding:utf8
+'''
+Lexicon backends: term -> id mappings used while indexing and to read .dic.
+
+Ids are given in insertion order starting from 0. DictLexicon is a plain
+dict; HashLexicon keeps all terms in one UTF-8 blob with an open
+addressing hash table of int32 slots, and can be saved to and loaded
+from a binformat image without re-hashing. A term costs its UTF-8 text
+plus 20 to 28 bytes (an 8 byte offset, a 4 byte hash and 2 to 4 table
+slots, 8 to 16 bytes), and 8 more for its id once terms were removed,
+instead of the ~100 of a dict entry with its unicode key.
+'''
+from __future__ import with_statement
+import os
+import codecs
+from zlib import crc32
+from array import array
+from bisect import bisect_left
+from binformat import CSRWriter, CSRFile
+
+class Lexicon(object):
+    '''Abstract lexicon interface'''
+    def get(self, token, default=-1):
+        '''id of a token, default if absent'''
+        raise NotImplementedError
+
+    def add(self, token):
+        '''id of a token, inserted with the next id if absent'''
+        raise NotImplementedError
+
+    def items(self):
+        '''iterator of (token, id)'''
+        raise NotImplementedError
+
+    def remove(self, tids):
+        '''forget the tokens of a set of ids; their ids are not given again'''
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __contains__(self, token):
+        return self.get(token) != -1
+
+class DictLexicon(Lexicon):
+    '''lexicon backed by a dict'''
+    def __init__(self):
+        self._ids = {}
+        self._next_id = 0
+
+    def get(self, token, default=-1):
+        return self._ids.get(token, default)
+
+    def add(self, token):
+        tid = self._ids.get(token)
+        if tid is None:
+            tid = self._ids[token] = self._next_id
+            self._next_id += 1
+        return tid
+
+    def __setitem__(self, token, tid):
+        '''set the id of a token explicitly, e.g. line numbers of a user dict'''
+        self._ids[token] = tid
+        self._next_id = max(self._next_id, tid + 1)
+
+    def items(self):
+        return self._ids.iteritems()
+
+    def remove(self, tids):
+        self._ids = dict((token, tid) for (token, tid) in self._ids.iteritems() if tid not in tids)
+
+    def __len__(self):
+        return len(self._ids)
+
+def _hash(key):
+    '''stable 31-bit hash of a utf8 string'''
+    return crc32(key) & 0x7fffffff
+
+def feature_hash(token, bits, signed=False):
+    '''
+    (feature id, sign) of a token for the hashing trick: the low bits of the
+    crc32 of its utf8 pick one of 2**bits ids (bits <= 31). Signed, the top
+    bit gives the sign so colliding tokens cancel out in expectation;
+    otherwise the sign is 1.
+    '''
+    hashval = crc32(token.encode('utf8')) & 0xffffffff
+    if signed and hashval & 0x80000000:
+        return hashval & ((1 << bits) - 1), -1
+    return hashval & ((1 << bits) - 1), 1
+
+class HashLexicon(Lexicon):
+    '''
+    Memory-compact lexicon: terms are stored back to back in a UTF-8 blob,
+    self._offsets[i]:self._offsets[i+1] holding the i-th term, and found
+    through a linear probing table of i+1 (0 for an empty slot). The i-th
+    term has id i until terms are removed; removing compacts the blob and
+    arrays, and self._ids then keeps the ascending ids of the terms left.
+    '''
+    def __init__(self, capacity=1024):
+        size = 1
+        while size < 2 * capacity:
+            size *= 2
+        self._blob = bytearray()
+        self._offsets = array('l', [0])
+        self._hashes = array('i')
+        self._table = array('i', [0]) * size
+        self._ids = None # id of every term once some were removed
+        self._next_id = 0
+
+    def _find(self, key, hashval):
+        '''(slot, index) of a key, index is -1 if absent and slot is where to insert it'''
+        table = self._table
+        mask = len(table) - 1
+        slot = hashval & mask
+        while True:
+            index = table[slot] - 1
+            if index < 0:
+                return slot, -1
+            if self._hashes[index] == hashval and \
+                    self._blob[self._offsets[index]:self._offsets[index+1]] == key:
+                return slot, index
+            slot = (slot + 1) & mask
+
+    def get(self, token, default=-1):
+        key = token.encode('utf8')
+        index = self._find(key, _hash(key))[1]
+        if index == -1:
+            return default
+        return index if self._ids is None else self._ids[index]
+
+    def add(self, token):
+        key = token.encode('utf8')
+        hashval = _hash(key)
+        slot, index = self._find(key, hashval)
+        if index != -1:
+            return index if self._ids is None else self._ids[index]
+        tid = self._next_id
+        self._next_id += 1
+        if self._ids is not None:
+            self._ids.append(tid)
+        self._blob.extend(key)
+        self._offsets.append(len(self._blob))
+        self._hashes.append(hashval)
+        self._table[slot] = len(self._hashes)
+        if 2 * len(self._hashes) > len(self._table):
+            self._rehash(2 * len(self._table))
+        return tid
+
+    def _rehash(self, size):
+        '''rebuild the table with size slots'''
+        table = array('i', [0]) * size
+        mask = size - 1
+        for index, hashval in enumerate(self._hashes):
+            slot = hashval & mask
+            while table[slot]:
+                slot = (slot + 1) & mask
+            table[slot] = index + 1
+        self._table = table
+
+    def _index(self, tid):
+        '''index of the term of an id in the blob and arrays'''
+        if self._ids is None:
+            return tid
+        return bisect_left(self._ids, tid)
+
+    def _term(self, index):
+        return str(self._blob[self._offsets[index]:self._offsets[index+1]]).decode('utf8')
+
+    def token(self, tid):
+        '''token of an id'''
+        return self._term(self._index(tid))
+
+    def items(self):
+        ids = self._ids
+        for index in xrange(len(self._hashes)):
+            yield self._term(index), index if ids is None else ids[index]
+
+    def remove(self, tids):
+        '''forget the tokens of a set of ids, moving the others down in the blob'''
+        if not tids:
+            return
+        blob = bytearray()
+        offsets = array('l', [0])
+        hashes = array('i')
+        ids = array('l')
+        old_ids = self._ids
+        for index in xrange(len(self._hashes)):
+            tid = index if old_ids is None else old_ids[index]
+            if tid in tids:
+                continue
+            blob.extend(self._blob[self._offsets[index]:self._offsets[index+1]])
+            offsets.append(len(blob))
+            hashes.append(self._hashes[index])
+            ids.append(tid)
+        self._blob = blob
+        self._offsets = offsets
+        self._hashes = hashes
+        self._ids = ids
+        self._rehash(len(self._table))
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def save(self, path):
+        '''save as a binformat lexicon image, ids must run from 0 without gaps'''
+        if self._ids is not None and len(self._ids) != self._next_id:
+            raise ValueError, "a lexicon with removed tokens has no image"
+        writer = CSRWriter(path, 'lexicon')
+        writer.add_block(self._hashes, self._offsets, array('B', str(self._blob)))
+        writer.add_column('table', self._table)
+        writer.close()
+
+    @staticmethod
+    def load(path):
+        '''load a lexicon image written by save()'''
+        image = CSRFile(path)
+        lexicon = HashLexicon(0)
+        lexicon._hashes = array('i', image.column('hashes').tostring())
+        lexicon._offsets = array('l', image.column('indptr').tostring())
+        lexicon._blob = bytearray(image.column('tokens').tostring())
+        lexicon._table = array('i', image.column('table').tostring())
+        lexicon._next_id = len(lexicon._hashes)
+        image.close()
+        return lexicon
+
+def image_filename(fndict):
+    '''lexicon image saved next to a .dic'''
+    return os.path.splitext(fndict)[0] + '.lex'
+
+def read_dic(fndict, encoding='utf8'):
+    '''
+    Read a .dic (one term per line, line number is the id). A lexicon image
+    saved next to it, and not older than it, is loaded instead of parsing.
+    '''
+    fnimage = image_filename(fndict)
+    if os.path.exists(fnimage) and os.path.getmtime(fnimage) >= os.path.getmtime(fndict):
+        return HashLexicon.load(fnimage)
+    lexicon = DictLexicon()
+    with codecs.open(fndict, 'r', encoding=encoding, errors='strict') as fdict:
+        for index, line in enumerate(fdict):
+            if isinstance(line, str):
+                line = line.decode(encoding, 'strict')
+            lexicon[line.strip()] = index
+    return lexicon
+
+def new_lexicon(backend):
+    '''create an empty lexicon of a backend: dict or hash'''
+    if backend == 'dict':
+        return DictLexicon()
+    elif backend == 'hash':
+        return HashLexicon()
+    raise NotImplementedError, "Not implemented lexicon backend %s" % backend
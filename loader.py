@@ -5,8 +5,48 @@ Loader interface and some build-in classes.
 '''
 from __future__ import with_statement
 import os
+import re
 import codecs
-from utility import check_required_params
+from utility import check_required_params, ordered_map, optional_import
+
+_META_CHARSET = re.compile(r'''<meta[^>]+charset\s*=\s*["']?([-\w.:]+)''', re.IGNORECASE)
+_HEADER_CHARSET = re.compile(r'''charset\s*=\s*["']?([-\w.:]+)''', re.IGNORECASE)
+_CHARSET_ALIASES = {'gb2312': 'gb18030', 'gbk': 'gb18030', 'x-gbk': 'gb18030'} # decode with the superset
+
+def _charset(name):
+    '''normalized codec name of a declared charset, None if unknown'''
+    name = name.lower()
+    name = _CHARSET_ALIASES.get(name, name)
+    try:
+        codecs.lookup(name)
+    except LookupError:
+        return None
+    return name
+
+def decode_html(content, content_type=None):
+    '''
+    Decode a fetched page: charset of the Content-Type header, else of a
+    <meta> tag in the head, else utf8 if it decodes, else gb18030.
+    '''
+    declared = []
+    if content_type:
+        match = _HEADER_CHARSET.search(content_type)
+        if match:
+            declared.append(match.group(1))
+    match = _META_CHARSET.search(content[:4096])
+    if match:
+        declared.append(match.group(1))
+    for name in declared:
+        name = _charset(name)
+        if name:
+            try:
+                return content.decode(name)
+            except UnicodeError:
+                pass # wrong declaration, sniff
+    try:
+        return content.decode('utf8')
+    except UnicodeError:
+        return content.decode('gb18030', 'ignore')
 
 class Loader(object):
     '''Abstract Loader interface'''
@@ -52,12 +92,23 @@ class LocalFileLoader(Loader):
             self._fd.close()
 
 class LocalFilelistLoader(Loader):
-    '''loader that handles a file with all files' paths in it '''
+    '''
+    loader that handles a file with all files' paths in it
+    params: src, encoding, prefetch (files read ahead by a thread pool,
+    default 0: read one by one), threads (reading threads, default 4),
+    order (list: as listed, default; inode: by directory and inode, faster
+    on cold disks when output order does not matter)
+    '''
     def __init__(self, params):
         super(LocalFilelistLoader, self).__init__()
         check_required_params(['src'], params)
         self._source = params['src']
         self._encoding = 'utf8' if 'encoding' not in params else params['encoding']
+        self._prefetch = int(params.get('prefetch', 0))
+        self._threads = int(params.get('threads', 4))
+        self._order = params.get('order', 'list')
+        if self._order not in ('list', 'inode'):
+            raise NotImplementedError, "Not implemented order %s" % self._order
         self._fd = None
     
     def open(self):
@@ -69,44 +120,148 @@ class LocalFilelistLoader(Loader):
                 self._fd.close()
                 self._fd = None
 
+    def _paths(self):
+        '''generator of the listed paths, in the configured order'''
+        paths = (line.strip() for line in self._fd)
+        paths = (path for path in paths if path)
+        if self._order == 'inode':
+            keys = []
+            for path in paths:
+                try:
+                    keys.append((os.path.dirname(path), os.stat(path).st_ino, path))
+                except OSError:
+                    continue # missing file
+            keys.sort()
+            paths = (path for (dirname, inode, path) in keys)
+        return paths
+
+    def _read(self, path):
+        '''(path, content) of a file, content is None if it cannot be read'''
+        try:
+            with codecs.open(path, mode='r', encoding=self._encoding, errors='ignore') as fditem:
+                return path, fditem.read()
+        except (IOError, OSError):
+            return path, None
+
     def items(self):
         '''generator for the items'''
-        if self._fd:
-            for line in self._fd:
-                line = line.strip()
-                if not line or not os.path.exists(line):
-                    continue
-                else:
-                    with codecs.open(line, mode='r', encoding=self._encoding, errors='ignore') as fditem:
-                        yield line, fditem.read()
+        if not self._fd:
+            return
+        if self._prefetch > 0:
+            contents = ordered_map(self._read, self._paths(), self._threads, self._prefetch)
+        else:
+            contents = (self._read(path) for path in self._paths())
+        for path, content in contents:
+            if content is not None:
+                yield path, content
 
     def close(self):
         '''close the connection'''
         if self._fd:
             self._fd.close()
 
+def line_ranges(path, parts):
+    '''split a file into parts (start, end) byte ranges, every one starting at a line'''
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for k in range(1, parts):
+            pos = max(size * k // parts, bounds[-1])
+            if pos > 0:
+                f.seek(pos - 1)
+                f.readline() # move to the first line starting at or after pos
+                pos = f.tell()
+            bounds.append(min(pos, size))
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+def _open_compressed(path):
+    '''binary file object of a plain, .gz or .zst file'''
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rb')
+    elif path.endswith('.zst'):
+        zstandard = optional_import('zstandard')
+        if zstandard is None:
+            raise NotImplementedError, "reading %s requires the zstandard module" % path
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return open(path, 'rb')
+
 class LocalKVFileLoader(Loader):
-    '''loader that handles a file with one document per line; doc key\ttxt'''
+    '''
+    loader that handles files with one document per line; doc key\ttxt
+    params: src (a file or a glob of shards, plain, .gz or .zst), encoding,
+    part (i/n: with several shards every n-th shard from the i-th, with one
+    plain file its i-th of n line aligned byte ranges)
+    '''
+    BLOCK_SIZE = 4 * 1024 * 1024 # bytes decoded at a time
+
     def __init__(self, params):
         super(LocalKVFileLoader, self).__init__()
         check_required_params(['src'], params)
         self._source = params['src']
         self._encoding = 'utf8' if 'encoding' not in params else params['encoding']
-        self._fd = None
+        self._part = None
+        if params.get('part'):
+            index, count = [int(x) for x in params['part'].split('/')]
+            if not 0 <= index < count:
+                raise ValueError, "bad part %s" % params['part']
+            self._part = (index, count)
+        self._files = None
     
     def open(self):
         '''open the source connection'''
-        try:
-            self._fd = codecs.open(self._source, mode='r', encoding=self._encoding, errors='ignore')
-        except IOError:
-            if self._fd:
-                self._fd.close()
-                self._fd = None
+        import glob
+        self._files = sorted(glob.glob(self._source))
+
+    def _blocks(self, f, size=None):
+        '''generator of byte strings of whole lines read in large blocks, up to size bytes'''
+        tail = ''
+        while True:
+            length = self.BLOCK_SIZE if size is None else min(self.BLOCK_SIZE, size)
+            block = f.read(length) if length > 0 else ''
+            if not block:
+                break
+            if size is not None:
+                size -= len(block)
+            block = tail + block
+            cut = block.rfind('\n') + 1
+            tail = block[cut:]
+            if cut:
+                yield block[:cut]
+        if tail:
+            yield tail
+
+    def _sources(self):
+        '''generator of the byte blocks of all files of this part'''
+        files = self._files
+        if self._part is None:
+            ranges = [(path, None) for path in files]
+        else:
+            index, count = self._part
+            if len(files) == 1 and not files[0].endswith(('.gz', '.zst')):
+                ranges = [(files[0], line_ranges(files[0], count)[index])]
+            else:
+                ranges = [(path, None) for path in files[index::count]]
+        for path, byte_range in ranges:
+            f = _open_compressed(path)
+            try:
+                if byte_range is None:
+                    for block in self._blocks(f):
+                        yield block
+                else:
+                    f.seek(byte_range[0])
+                    for block in self._blocks(f, byte_range[1] - byte_range[0]):
+                        yield block
+            finally:
+                f.close()
 
     def items(self):
         '''generator for the items'''
-        if self._fd:
-            for line in self._fd:
+        if not self._files:
+            return
+        for block in self._sources():
+            for line in block.decode(self._encoding, 'ignore').split(u'\n'):
                 line = line.strip()
                 parts = line.split('\t')
                 if not parts or len(parts) != 2:
@@ -116,8 +271,7 @@ class LocalKVFileLoader(Loader):
 
     def close(self):
         '''close the connection'''
-        if self._fd:
-            self._fd.close()
+        self._files = None
 
 class WebLoader(Loader):
     '''loader that handles a single web page represented by URL'''
@@ -135,19 +289,130 @@ class WebLoader(Loader):
     def items(self):
         if self._doc:
             content = self._doc.read()
-            ucontent = ''
-            try:
-                ucontent = content.decode('utf8')
-            except UnicodeError:
-                try:
-                    ucontent = content.decode('gb2312')
-                except UnicodeError:
-                    pass
-            yield self._url, ucontent
+            yield self._url, decode_html(content, self._doc.info().getheader('content-type'))
 
     def close(self):
         self._doc = None
 
+class UrlListLoader(Loader):
+    '''
+    loader that fetches all URLs listed in a file, one per line. Pages are
+    fetched concurrently by a pool of threads, each keeping one connection
+    per host alive, and come out in the order of the list; pages that
+    cannot be fetched are skipped.
+    params: src, encoding, workers (default 16), timeout (seconds, default
+    10), retries (default 2)
+    '''
+    MAX_REDIRECTS = 5
+
+    def __init__(self, params):
+        super(UrlListLoader, self).__init__()
+        check_required_params(['src'], params)
+        self._source = params['src']
+        self._encoding = 'utf8' if 'encoding' not in params else params['encoding']
+        self._workers = int(params.get('workers', 16))
+        self._timeout = float(params.get('timeout', 10))
+        self._retries = int(params.get('retries', 2))
+        self._fd = None
+        self._local = None
+
+    def open(self):
+        '''open the source connection'''
+        import threading
+        try:
+            self._fd = codecs.open(self._source, mode='r', encoding=self._encoding, errors='ignore')
+        except IOError:
+            if self._fd:
+                self._fd.close()
+                self._fd = None
+        self._local = threading.local() # connections of every fetching thread
+
+    def _urls(self):
+        '''generator of the listed URLs'''
+        for line in self._fd:
+            line = line.strip()
+            if line:
+                yield line.encode('utf8')
+
+    def _connection(self, scheme, netloc):
+        '''kept-alive connection of the current thread to a host'''
+        import httplib
+        connections = self._local.__dict__.setdefault('connections', {})
+        key = (scheme, netloc)
+        if key not in connections:
+            if scheme == 'https':
+                connections[key] = httplib.HTTPSConnection(netloc, timeout=self._timeout)
+            else:
+                connections[key] = httplib.HTTPConnection(netloc, timeout=self._timeout)
+        return connections[key]
+
+    def _drop_connection(self, scheme, netloc):
+        '''close a broken connection, the next request reconnects'''
+        connection = self._local.__dict__.get('connections', {}).pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def _request(self, url):
+        '''(status, headers, body) of a GET, following redirects'''
+        import urlparse
+        for i in range(self.MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            connection = self._connection(parts.scheme, parts.netloc)
+            connection.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+            response = connection.getresponse()
+            body = response.read() # read it all so the connection can be reused
+            if response.getheader('connection', '').lower() == 'close':
+                self._drop_connection(parts.scheme, parts.netloc)
+            location = response.getheader('location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urlparse.urljoin(url, location)
+                continue
+            if response.getheader('content-encoding', '').lower() == 'gzip':
+                import zlib
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            return response.status, response, body
+        return None, None, None
+
+    def _fetch(self, url):
+        '''(url, content) of a page, content is None if it cannot be fetched'''
+        import time
+        import zlib
+        import socket
+        import httplib
+        import urlparse
+        for attempt in range(self._retries + 1):
+            try:
+                status, response, body = self._request(url)
+            except (socket.error, httplib.HTTPException, IOError, zlib.error):
+                parts = urlparse.urlsplit(url)
+                self._drop_connection(parts.scheme, parts.netloc)
+                status = None
+            else:
+                if status == 200:
+                    return url, decode_html(body, response.getheader('content-type'))
+                if status is None or status < 500:
+                    return url, None # client error or redirect loop, not worth retrying
+            if attempt < self._retries:
+                time.sleep(0.5 * 2 ** attempt)
+        return url, None
+
+    def items(self):
+        '''generator for the items'''
+        if self._fd:
+            for url, content in ordered_map(self._fetch, self._urls(), self._workers):
+                if content is not None:
+                    yield url.decode('utf8'), content
+
+    def close(self):
+        '''close the connection'''
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+        self._local = None
+
 class TextLoader(Loader):
     '''loader that handles a text content'''
     def __init__(self, params):
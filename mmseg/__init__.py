@@ -1,16 +1,47 @@
 #encoding:utf8
+'''
+MMSeg Chinese segmentation. The dictionaries are loaded on first use, not
+at import, so importing mmseg costs nothing for runs that never segment.
+'''
+from __future__ import with_statement
 import os
-from _mmseg import Dictionary as _Dictionary, Token, Algorithm
+import threading
+from _mmseg import Dictionary as _Dictionary, Token, Algorithm as _Algorithm
 import _mmseg as mmseg
+try:
+    from _mmseg import segment as _segment, segment_many as _segment_many
+except ImportError: # extension built before the batch API
+    def _segment(text):
+        return [(tok.start, tok.end) for tok in _Algorithm(text)]
+
+    def _segment_many(texts):
+        return [_segment(text) for text in texts]
 
 class Dictionary(_Dictionary):
     dictionaries = (
         ('chars', os.path.join(os.path.dirname(__file__), 'data', 'chars.dic')),
         ('words', os.path.join(os.path.dirname(__file__), 'data', 'words.dic')),
     )
+    # binary image compiled from the dictionaries above by compile_dict.py
+    image = os.path.join(os.path.dirname(__file__), 'data', 'dict.img')
+
+    @staticmethod
+    def image_fresh():
+        if not hasattr(_Dictionary, 'load_image'): # extension built before images
+            return False
+        if not os.path.exists(Dictionary.image):
+            return False
+        mtime = os.path.getmtime(Dictionary.image)
+        return all([os.path.getmtime(d) <= mtime for t, d in Dictionary.dictionaries])
 
     @staticmethod
     def load_dictionaries():
+        if Dictionary.image_fresh() and Dictionary.load_image(Dictionary.image):
+            return
+        Dictionary.load_text_dictionaries()
+
+    @staticmethod
+    def load_text_dictionaries():
         for t, d in Dictionary.dictionaries:
             if t == 'chars':
                 if not Dictionary.load_chars(d):
@@ -19,12 +50,47 @@ class Dictionary(_Dictionary):
                 if not Dictionary.load_words(d):
                     raise IOError("Cannot open '%s'" % d)
 
-dict_load_defaults = Dictionary.load_dictionaries
-dict_load_defaults()
- 
+    @staticmethod
+    def add(*args, **kwds):
+        dict_load_defaults() # added words override the defaults
+        return _Dictionary.add(*args, **kwds)
+
+    @staticmethod
+    def has_word(word):
+        dict_load_defaults()
+        return _Dictionary.has_word(word)
+
+_loaded = False
+_load_lock = threading.Lock()
+
+def dict_load_defaults():
+    '''load the default dictionaries once'''
+    global _loaded
+    if _loaded:
+        return
+    with _load_lock:
+        if not _loaded:
+            Dictionary.load_dictionaries()
+            _loaded = True
+
+def Algorithm(*args, **kwds):
+    '''segmentation iterator of a text'''
+    dict_load_defaults()
+    return _Algorithm(*args, **kwds)
+
+def segment(text):
+    '''(start, end) spans of the words of a text, characters for unicode and bytes for str'''
+    dict_load_defaults()
+    return _segment(text)
+
+def segment_many(texts):
+    '''spans of the words of every text of a list'''
+    dict_load_defaults()
+    return _segment_many(texts)
+
 def seg_txt(text):
     if type(text) is str:
-        algor = mmseg.Algorithm(text)
+        algor = Algorithm(text)
         for tok in algor:
             yield tok.text
     else:
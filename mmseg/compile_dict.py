@@ -0,0 +1,36 @@
+#!/usr/local/bin/python
+#encoding:utf8
+'''
+Compile the text dictionaries of mmseg into the binary image that is
+memory-mapped at import instead of parsing them. Run it once after the
+dictionaries change; a stale image is ignored.
+'''
+import os
+import sys
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mmseg import Dictionary
+
+def getopts():
+    '''parse options'''
+    usage = "compile mmseg dictionaries into a binary image"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-o", "--output", dest="output", default=Dictionary.image,
+            help="image file [default: %default]")
+    options = parser.parse_args()[0]
+    return options.output
+
+def main():
+    '''main entry'''
+    fnimage = getopts()
+    if not hasattr(Dictionary, 'save_image'):
+        print "_mmseg is built without image support, rebuild it with mmseg-cpp/build.py"
+        sys.exit(-1)
+    Dictionary.load_text_dictionaries()
+    if not Dictionary.save_image(fnimage):
+        print "Cannot write '%s'" % fnimage
+        sys.exit(-1)
+
+if __name__ == "__main__":
+    main()
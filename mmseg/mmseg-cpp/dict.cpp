@@ -1,4 +1,11 @@
 #include <cstdio>
+#include <vector>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <sys/types.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <pthread.h>
 
 #include "dict.h"
 
@@ -38,6 +45,21 @@ namespace rmmseg
     static Entry **bins = static_cast<Entry **>(std::calloc(init_size,
                                                             sizeof(Entry *)));
 
+    /*
+     * Segmentation without the GIL reads the dictionary under the shared
+     * lock, while add() and load_image() change it under the exclusive
+     * one, so a reader never sees bins freed by rehash() or an image
+     * unmapped under it.
+     */
+    static pthread_rwlock_t rwlock = PTHREAD_RWLOCK_INITIALIZER;
+
+    class ExclusiveLock
+    {
+    public:
+        ExclusiveLock() { pthread_rwlock_wrlock(&rwlock); }
+        ~ExclusiveLock() { pthread_rwlock_unlock(&rwlock); }
+    };
+
     static size_t new_size()
     {
         for (size_t i = 0;
@@ -94,6 +116,80 @@ namespace rmmseg
         bins = new_bins;
     }
 
+    /*
+     * Binary dictionary image:
+     *  - header
+     *  - n_bins+1 uint32 bin bounds: the entries of bin i are
+     *    entries[bounds[i]:bounds[i+1]]
+     *  - n_entries uint32 entries: offsets of words in the word area
+     *  - word area: Word structs back to back, aligned to img_align
+     * Everything is addressed by offsets so the file is mapped as is.
+     */
+    const char img_magic[8] = {'M', 'M', 'S', 'E', 'G', 'I', 'M', 'G'};
+    const unsigned int img_version = 1;
+    const size_t img_align = 4;
+
+    struct ImageHeader
+    {
+        char         magic[8];
+        unsigned int version;
+        unsigned int n_bins;
+        unsigned int n_entries;
+        unsigned int words_size;   /* bytes of the word area */
+    };
+
+    static char *img_base = NULL;
+    static size_t img_size = 0;
+    static const ImageHeader *img_header = NULL;
+    static const unsigned int *img_bounds = NULL;
+    static const unsigned int *img_entries = NULL;
+    static const char *img_words = NULL;
+
+    static size_t word_size(const Word *word)
+    {
+        size_t size = sizeof(Word) + word->nbytes + 1 - word_embed_len;
+        return (size + img_align - 1) / img_align * img_align;
+    }
+
+    static Word *img_get(const char *str, int len)
+    {
+        if (!img_header)
+            return NULL;
+        unsigned int h = hash(str, len) % img_header->n_bins;
+        for (unsigned int i = img_bounds[h]; i < img_bounds[h+1]; ++i)
+        {
+            Word *word = (Word *)(img_words + img_entries[i]);
+            if (len == word->nbytes &&
+                strncmp(str, word->text, len) == 0)
+                return word;
+        }
+        return NULL;
+    }
+
+    /* look a word up in the hash table of loaded and added words */
+    static Word *heap_get(const char *str, int len)
+    {
+        unsigned int h = hash(str, len) % n_bins;
+        for (Entry *entry = bins[h]; entry; entry = entry->next)
+        {
+            if (len == entry->word->nbytes &&
+                strncmp(str, entry->word->text, len) == 0)
+                return entry->word;
+        }
+        return NULL;
+    }
+
+    static void img_unload()
+    {
+        if (img_base)
+            munmap(img_base, img_size);
+        img_base = NULL;
+        img_size = 0;
+        img_header = NULL;
+        img_bounds = img_entries = NULL;
+        img_words = NULL;
+    }
+
     namespace dict
     {
 
@@ -106,24 +202,13 @@ namespace rmmseg
          */
         Word *get(const char *str, int len)
         {
-            unsigned int h = hash(str, len) % n_bins;
-            Entry *entry = bins[h];
-            if (!entry)
-                return NULL;
-            do
-            {
-                if (len == entry->word->nbytes &&
-                    strncmp(str, entry->word->text, len) == 0)
-                    return entry->word;
-                entry = entry->next;
-            }
-            while (entry);
-
-            return NULL;
+            Word *word = heap_get(str, len);
+            return word ? word : img_get(str, len);
         }
 
         void add(Word *word)
         {
+            ExclusiveLock lock;
             unsigned int hash_val = hash(word->text, word->nbytes);
             unsigned int h = hash_val % n_bins;
             Entry *entry = bins[h];
@@ -173,6 +258,16 @@ namespace rmmseg
             }
         }
 
+        void lock_shared()
+        {
+            pthread_rwlock_rdlock(&rwlock);
+        }
+
+        void unlock_shared()
+        {
+            pthread_rwlock_unlock(&rwlock);
+        }
+
         bool load_chars(const char *filename)
         {
             FILE *fp = fopen(filename, "r");
@@ -226,5 +321,122 @@ namespace rmmseg
             fclose(fp);
             return true;
         }
+
+        /**
+         * Write all words, those of a loaded image included, to a binary
+         * image file.
+         */
+        bool save_image(const char *filename)
+        {
+            std::vector<Word *> words;
+            for (size_t i = 0; i < n_bins; ++i)
+                for (Entry *entry = bins[i]; entry; entry = entry->next)
+                    words.push_back(entry->word);
+            if (img_header)
+            {
+                for (unsigned int i = 0; i < img_header->n_entries; ++i)
+                {
+                    Word *word = (Word *)(img_words + img_entries[i]);
+                    if (!heap_get(word->text, word->nbytes))
+                        words.push_back(word);
+                }
+            }
+
+            ImageHeader header;
+            memcpy(header.magic, img_magic, sizeof(img_magic));
+            header.version = img_version;
+            header.n_bins = static_cast<unsigned int>(primes[0]);
+            for (size_t i = 0; i < sizeof(primes)/sizeof(primes[0]); ++i)
+            {
+                header.n_bins = static_cast<unsigned int>(primes[i]);
+                if (primes[i] > words.size())
+                    break;
+            }
+            header.n_entries = static_cast<unsigned int>(words.size());
+
+            /* lay words out bin by bin */
+            std::vector<unsigned int> bounds(header.n_bins + 1, 0);
+            std::vector<unsigned int> word_bins(words.size());
+            for (size_t i = 0; i < words.size(); ++i)
+            {
+                word_bins[i] = hash(words[i]->text, words[i]->nbytes) % header.n_bins;
+                bounds[word_bins[i] + 1]++;
+            }
+            for (size_t i = 0; i < header.n_bins; ++i)
+                bounds[i + 1] += bounds[i];
+            std::vector<Word *> order(words.size());
+            std::vector<unsigned int> fill(bounds.begin(), bounds.end() - 1);
+            for (size_t i = 0; i < words.size(); ++i)
+                order[fill[word_bins[i]]++] = words[i];
+            std::vector<unsigned int> entries(words.size());
+            size_t offset = 0;
+            for (size_t i = 0; i < order.size(); ++i)
+            {
+                entries[i] = static_cast<unsigned int>(offset);
+                offset += word_size(order[i]);
+            }
+            header.words_size = static_cast<unsigned int>(offset);
+
+            FILE *fp = fopen(filename, "wb");
+            if (!fp)
+                return false;
+            bool ok = fwrite(&header, sizeof(header), 1, fp) == 1 &&
+                fwrite(&bounds[0], sizeof(unsigned int), bounds.size(), fp) == bounds.size() &&
+                (entries.empty() ||
+                 fwrite(&entries[0], sizeof(unsigned int), entries.size(), fp) == entries.size());
+            char padding[img_align] = {0};
+            for (size_t i = 0; ok && i < order.size(); ++i)
+            {
+                size_t size = sizeof(Word) + order[i]->nbytes + 1 - word_embed_len;
+                ok = fwrite(order[i], size, 1, fp) == 1 &&
+                    (word_size(order[i]) == size ||
+                     fwrite(padding, word_size(order[i]) - size, 1, fp) == 1);
+            }
+            return fclose(fp) == 0 && ok;
+        }
+
+        /**
+         * Map a binary image read-only, replacing any image loaded before.
+         */
+        bool load_image(const char *filename)
+        {
+            int fd = open(filename, O_RDONLY);
+            if (fd < 0)
+                return false;
+            struct stat st;
+            if (fstat(fd, &st) != 0 ||
+                static_cast<size_t>(st.st_size) < sizeof(ImageHeader))
+            {
+                close(fd);
+                return false;
+            }
+            size_t size = static_cast<size_t>(st.st_size);
+            void *base = mmap(NULL, size, PROT_READ, MAP_SHARED, fd, 0);
+            close(fd);
+            if (base == MAP_FAILED)
+                return false;
+
+            const ImageHeader *header = static_cast<const ImageHeader *>(base);
+            if (memcmp(header->magic, img_magic, sizeof(img_magic)) != 0 ||
+                header->version != img_version ||
+                header->n_bins == 0 ||
+                size != sizeof(ImageHeader)
+                    + sizeof(unsigned int) * (header->n_bins + 1 + static_cast<size_t>(header->n_entries))
+                    + header->words_size)
+            {
+                munmap(base, size);
+                return false;
+            }
+
+            ExclusiveLock lock;
+            img_unload();
+            img_base = static_cast<char *>(base);
+            img_size = size;
+            img_header = header;
+            img_bounds = reinterpret_cast<const unsigned int *>(img_base + sizeof(ImageHeader));
+            img_entries = img_bounds + header->n_bins + 1;
+            img_words = reinterpret_cast<const char *>(img_entries + header->n_entries);
+            return true;
+        }
     }
 }
@@ -15,6 +15,11 @@
  *                    The frequency should NOT exceeds 65535.
  *  - word file:      Each line contains a number and a word, the
  *                    number is the character count of the word.
+ *
+ * A loaded dictionary can be saved as a binary image, which is later
+ * memory-mapped read-only instead of parsing the text files again, so
+ * all processes using the same image share one physical copy of it.
+ * Words added after an image is loaded take precedence over it.
  */
 
 namespace rmmseg
@@ -28,6 +33,21 @@ namespace rmmseg
         bool  load_chars(const char *filename);
         bool  load_words(const char *filename);
         Word *get(const char *str, int len);
+        bool  save_image(const char *filename);
+        bool  load_image(const char *filename);
+
+        /* Readers that do not hold the GIL, i.e. segmentation run with
+         * the GIL released, look words up between lock_shared() and
+         * unlock_shared(); add() and load_image() wait for them. */
+        void  lock_shared();
+        void  unlock_shared();
+
+        class SharedLock
+        {
+        public:
+            SharedLock() { lock_shared(); }
+            ~SharedLock() { unlock_shared(); }
+        };
     }
 }
 
@@ -8,6 +8,9 @@
 #include <structmember.h>
 #include <unicodeobject.h>
 
+#include <string>
+#include <vector>
+
 #include "utils.h"
 #include "token.h"
 #include "dict.h"
@@ -48,6 +51,34 @@ mmseg_Dictionary_load_words(PyObject *self, PyObject *args)
 	return (PyObject *)Py_False;
 }
 
+static PyObject *
+mmseg_Dictionary_save_image(PyObject *self, PyObject *args)
+{
+	char *path;
+	if (PyArg_ParseTuple(args, "s", &path)) {
+		if (rmmseg::dict::save_image(path)) {
+			Py_INCREF(Py_True);
+			return (PyObject *)Py_True;
+		}
+	}
+	Py_INCREF(Py_False);
+	return (PyObject *)Py_False;
+}
+
+static PyObject *
+mmseg_Dictionary_load_image(PyObject *self, PyObject *args)
+{
+	char *path;
+	if (PyArg_ParseTuple(args, "s", &path)) {
+		if (rmmseg::dict::load_image(path)) {
+			Py_INCREF(Py_True);
+			return (PyObject *)Py_True;
+		}
+	}
+	Py_INCREF(Py_False);
+	return (PyObject *)Py_False;
+}
+
 static PyObject *
 mmseg_Dictionary_add(PyObject *self, PyObject *args, PyObject *kwds)
 {
@@ -120,6 +151,8 @@ mmseg_Dictionary_has_word(PyObject *self, PyObject *obj)
 static PyMethodDef mmseg_Dictionary_methods[] = {
 	{"load_chars", (PyCFunction)mmseg_Dictionary_load_chars, METH_VARARGS | METH_STATIC, "Load a characters dictionary from a file."},
 	{"load_words", (PyCFunction)mmseg_Dictionary_load_words, METH_VARARGS | METH_STATIC, "Load a words dictionary from a file."},
+	{"save_image", (PyCFunction)mmseg_Dictionary_save_image, METH_VARARGS | METH_STATIC, "Save all loaded words as a binary dictionary image."},
+	{"load_image", (PyCFunction)mmseg_Dictionary_load_image, METH_VARARGS | METH_STATIC, "Memory-map a binary dictionary image read-only."},
 	{"add", (PyCFunction)mmseg_Dictionary_add, METH_KEYWORDS | METH_STATIC, "Add a word to the in-memory dictionary."},
 	{"has_word", (PyCFunction)mmseg_Dictionary_has_word, METH_O | METH_STATIC, "Check whether one word is included in the dictionary."},
 	{NULL, NULL, 0, NULL}        /* Sentinel */
@@ -476,11 +509,165 @@ static PyTypeObject mmseg_AlgorithmType = {
 };
 
 
-/* Python constructor */
+/* Batch segmentation */
+
+/* Number of Py_UNICODE code units a UTF-8 byte starts. */
+static inline int
+utf8_units(unsigned char ch)
+{
+	if (ch >= 0x80 && ch <= 0xBF)
+		return 0;  /* continuation byte */
+	if (ch >= 0xF0)
+		return Py_UNICODE_SIZE == 2 ? 2 : 1;  /* surrogate pair on narrow builds */
+	return 1;
+}
+
+/* Get the UTF-8 bytes of a str or unicode object. */
+static int
+mmseg_utf8_of(PyObject *obj, std::string &utf8, int *is_unicode)
+{
+	if (PyString_Check(obj)) {
+		/* A plain ASCII string is also a valid UTF-8 string */
+		utf8.assign(PyString_AS_STRING(obj), PyString_GET_SIZE(obj));
+		*is_unicode = 0;
+		return 0;
+	} else if (PyUnicode_Check(obj)) {
+		PyObject *tmp = PyUnicode_AsUTF8String(obj);
+		if (tmp == NULL)
+			return -1;
+		utf8.assign(PyString_AS_STRING(tmp), PyString_GET_SIZE(tmp));
+		Py_DECREF(tmp);
+		*is_unicode = 1;
+		return 0;
+	}
+	PyErr_SetString(PyExc_TypeError, "text must be str or unicode");
+	return -1;
+}
+
+/*
+ * Segment a UTF-8 text into [start, end) spans, flattened into spans.
+ * Offsets are in bytes, or in code units of the decoded text if units is
+ * set. Only reads the dictionary, so it runs without the GIL, under the
+ * shared dictionary lock taken by the caller.
+ */
+static void
+mmseg_segment_utf8(const std::string &utf8, int units, std::vector<int> &spans)
+{
+	const char *text = utf8.data();
+	int length = static_cast<int>(utf8.size());
+	rmmseg::Algorithm algorithm(text, length);
+	int pos = 0, unit = 0;
+
+	for (;;) {
+		rmmseg::Token rtk = algorithm.next_token();
+		if (rtk.text == NULL)
+			break;
+		int start = static_cast<int>(rtk.text - text);
+		int end = start + rtk.length;
+		if (units) {
+			for (; pos < start; ++pos)
+				unit += utf8_units(text[pos]);
+			start = unit;
+			for (; pos < end; ++pos)
+				unit += utf8_units(text[pos]);
+			end = unit;
+		}
+		spans.push_back(start);
+		spans.push_back(end);
+	}
+}
+
+/* Build a list of (start, end) tuples. */
+static PyObject *
+mmseg_spans_list(const std::vector<int> &spans)
+{
+	Py_ssize_t n = static_cast<Py_ssize_t>(spans.size() / 2);
+	PyObject *list = PyList_New(n);
+	if (list == NULL)
+		return NULL;
+	for (Py_ssize_t i = 0; i < n; ++i) {
+		PyObject *span = PyTuple_New(2);
+		if (span == NULL) {
+			Py_DECREF(list);
+			return NULL;
+		}
+		PyTuple_SET_ITEM(span, 0, PyInt_FromLong(spans[2*i]));
+		PyTuple_SET_ITEM(span, 1, PyInt_FromLong(spans[2*i+1]));
+		PyList_SET_ITEM(list, i, span);
+	}
+	return list;
+}
+
+static PyObject *
+mmseg_segment(PyObject *self, PyObject *obj)
+{
+	std::string utf8;
+	std::vector<int> spans;
+	int is_unicode;
+
+	if (mmseg_utf8_of(obj, utf8, &is_unicode) < 0)
+		return NULL;
+
+	Py_BEGIN_ALLOW_THREADS
+	{
+		rmmseg::dict::SharedLock lock; /* released before the GIL is taken back */
+		mmseg_segment_utf8(utf8, is_unicode, spans);
+	}
+	Py_END_ALLOW_THREADS
+
+	return mmseg_spans_list(spans);
+}
+
+static PyObject *
+mmseg_segment_many(PyObject *self, PyObject *obj)
+{
+	PyObject *seq, *result;
+	Py_ssize_t n, i;
+
+	seq = PySequence_Fast(obj, "texts must be a sequence");
+	if (seq == NULL)
+		return NULL;
+	n = PySequence_Fast_GET_SIZE(seq);
+
+	std::vector<std::string> texts(n);
+	std::vector<int> is_unicode(n);
+	std::vector<std::vector<int> > spans(n);
+	for (i = 0; i < n; ++i) {
+		if (mmseg_utf8_of(PySequence_Fast_GET_ITEM(seq, i), texts[i], &is_unicode[i]) < 0) {
+			Py_DECREF(seq);
+			return NULL;
+		}
+	}
+	Py_DECREF(seq);
+
+	Py_BEGIN_ALLOW_THREADS
+	{
+		rmmseg::dict::SharedLock lock; /* released before the GIL is taken back */
+		for (i = 0; i < n; ++i)
+			mmseg_segment_utf8(texts[i], is_unicode[i], spans[i]);
+	}
+	Py_END_ALLOW_THREADS
+
+	result = PyList_New(n);
+	if (result == NULL)
+		return NULL;
+	for (i = 0; i < n; ++i) {
+		PyObject *list = mmseg_spans_list(spans[i]);
+		if (list == NULL) {
+			Py_DECREF(result);
+			return NULL;
+		}
+		PyList_SET_ITEM(result, i, list);
+	}
+	return result;
+}
+
 
 /* Module functions */
 
 static PyMethodDef mmseg_methods[] = {
+	{"segment", (PyCFunction)mmseg_segment, METH_O, "Segment a text, return a list of (start, end) token spans. Offsets are bytes for str and characters for unicode."},
+	{"segment_many", (PyCFunction)mmseg_segment_many, METH_O, "Segment a sequence of texts in one call without holding the GIL, return a list of span lists."},
 	{NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
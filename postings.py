@@ -0,0 +1,206 @@
+#!/usr/local/bin/python
+#encoding:utf8
+'''
+Postings storage used while indexing: collects (tokenid, docid) pairs and
+gives them back grouped by tokenid, both in ascending order.
+'''
+from __future__ import with_statement
+import os
+import heapq
+from array import array
+
+_MASK = 0xffffffff
+_PAIR_BYTES = 40 # approximate cost of one buffered pair: int object and list slot
+_POSTING_BYTES = 4 # cost of one posting in a docid array
+_LIST_BYTES = 128 # approximate cost of a token's docid array and its dict entry
+_BLOCK = 65536 # pairs read from a run at a time
+
+def _write_run(filename, keys):
+    '''write sorted keys to a binary run of uint32 (tokenid, docid) pairs'''
+    pairs = array('I')
+    last = -1
+    for key in keys:
+        if key == last:
+            continue # duplicate posting
+        pairs.append(key >> 32)
+        pairs.append(key & _MASK)
+        last = key
+    with open(filename, 'wb') as frun:
+        pairs.tofile(frun)
+
+def _read_run(filename):
+    '''generator of keys stored in a binary run'''
+    with open(filename, 'rb') as frun:
+        while True:
+            pairs = array('I')
+            try:
+                pairs.fromfile(frun, 2 * _BLOCK)
+            except EOFError:
+                pass # partial block at the end of the run
+            if not pairs:
+                break
+            for i in xrange(0, len(pairs), 2):
+                yield (pairs[i] << 32) | pairs[i+1]
+
+class PostingSorter(object):
+    '''
+    External merge sort of postings. Pairs are buffered in memory; when
+    the buffer exceeds the memory budget it is sorted and spilled to a
+    binary run file. Reading the postings k-way merges all runs with the
+    remaining buffer, without any text round-trip.
+    '''
+    def __init__(self, path_prefix, memory=256*1024*1024, fanin=128):
+        self.path_prefix = path_prefix # runs are path_prefix.0, path_prefix.1, ...
+        self.max_buffer = max(memory // _PAIR_BYTES, 1024)
+        self.fanin = fanin # max runs kept before they are merged into one
+        self._keys = []
+        self._runs = []
+        self._next_run = 0
+
+    def add(self, tokenid, docid):
+        '''add a single posting'''
+        self._keys.append((tokenid << 32) | docid)
+        if len(self._keys) >= self.max_buffer:
+            self._spill()
+
+    def add_doc(self, docid, tokenids):
+        '''add postings of all tokens occurring in a document'''
+        self._keys.extend([(tokenid << 32) | docid for tokenid in tokenids])
+        if len(self._keys) >= self.max_buffer:
+            self._spill()
+
+    def add_token(self, tokenid, docids):
+        '''add postings of a token occurring in all docids'''
+        key = tokenid << 32
+        self._keys.extend([key | docid for docid in docids])
+        if len(self._keys) >= self.max_buffer:
+            self._spill()
+
+    def _new_run(self):
+        '''return file name for a new run'''
+        filename = "%s.%d" % (self.path_prefix, self._next_run)
+        self._next_run += 1
+        self._runs.append(filename)
+        return filename
+
+    def _spill(self):
+        '''sort the buffer and write it out as a run'''
+        self._keys.sort()
+        _write_run(self._new_run(), self._keys)
+        self._keys = []
+        if len(self._runs) >= self.fanin:
+            runs = self._runs
+            self._runs = []
+            _write_run(self._new_run(), heapq.merge(*[_read_run(run) for run in runs]))
+            for run in runs:
+                os.remove(run)
+
+    def keys(self):
+        '''generator of all distinct postings as (tokenid << 32 | docid), sorted'''
+        self._keys.sort()
+        if not self._runs:
+            sources = self._keys
+        else:
+            sources = heapq.merge(self._keys, *[_read_run(run) for run in self._runs])
+        last = -1
+        for key in sources:
+            if key != last:
+                yield key
+                last = key
+
+    def groups(self):
+        '''generator of (tokenid, docids) in ascending tokenid, docids ascending'''
+        lasttid = -1
+        docids = array('I')
+        for key in self.keys():
+            tid = key >> 32
+            if tid != lasttid:
+                if docids:
+                    yield lasttid, docids
+                    docids = array('I')
+                lasttid = tid
+            docids.append(key & _MASK)
+        if docids:
+            yield lasttid, docids
+
+    def close(self):
+        '''drop buffered postings and remove run files'''
+        self._keys = []
+        for run in self._runs:
+            if os.path.exists(run):
+                os.remove(run)
+        self._runs = []
+
+class Postings(object):
+    '''
+    Postings kept as one compact array('I') of docids per token, filled in
+    a single pass while documents stream in. When the arrays grow beyond the
+    memory threshold they are handed over to a PostingSorter and indexing
+    continues on the disk spill path.
+    '''
+    def __init__(self, path_prefix, memory=512*1024*1024, sort_memory=256*1024*1024):
+        self.path_prefix = path_prefix
+        self.memory = memory # bytes of in-memory postings before spilling
+        self.sort_memory = sort_memory
+        self._lists = {} # tokenid -> array('I') of docids
+        self._size = 0 # estimated bytes used by self._lists
+        self._sorter = None
+
+    def spilled(self):
+        '''whether postings have switched to the disk path'''
+        return self._sorter is not None
+
+    def add_doc(self, docid, tokenids):
+        '''add postings of all tokens occurring in a document'''
+        if self._sorter is not None:
+            self._sorter.add_doc(docid, tokenids)
+            return
+        lists = self._lists
+        count = len(lists)
+        for tokenid in tokenids:
+            docids = lists.get(tokenid)
+            if docids is None:
+                docids = lists[tokenid] = array('I')
+            docids.append(docid)
+        self._size += len(tokenids) * _POSTING_BYTES + (len(lists) - count) * _LIST_BYTES
+        if self._size > self.memory:
+            self._spill()
+
+    def discard(self, tokenids):
+        '''
+        drop the in-memory postings of tokens, e.g. rare tokens evicted from
+        the vocabulary; postings already spilled to disk are kept and the
+        reader is expected to skip them
+        '''
+        lists = self._lists
+        for tokenid in tokenids:
+            docids = lists.pop(tokenid, None)
+            if docids is not None:
+                self._size -= len(docids) * _POSTING_BYTES + _LIST_BYTES
+
+    def _spill(self):
+        '''move in-memory postings to a PostingSorter'''
+        self._sorter = PostingSorter(self.path_prefix, self.sort_memory)
+        lists = self._lists
+        for tokenid in sorted(lists):
+            self._sorter.add_token(tokenid, lists.pop(tokenid))
+        self._size = 0
+
+    def groups(self):
+        '''generator of (tokenid, docids) in ascending tokenid, docids ascending'''
+        if self._sorter is not None:
+            for group in self._sorter.groups():
+                yield group
+        else:
+            # docids are appended in docid order, so every array is already sorted
+            lists = self._lists
+            for tokenid in sorted(lists):
+                yield tokenid, lists[tokenid]
+
+    def close(self):
+        '''drop postings and remove spilled runs'''
+        self._lists = {}
+        self._size = 0
+        if self._sorter is not None:
+            self._sorter.close()
+            self._sorter = None
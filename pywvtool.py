@@ -7,15 +7,125 @@ from __future__ import with_statement
 import sys
 import os
 from math import sqrt, log
+from zlib import adler32
 import codecs
+from array import array
+from itertools import islice, chain
+from collections import deque
+from postings import Postings
+from binformat import CSRWriter, CSRFile
+from lexicon import DictLexicon, HashLexicon, new_lexicon, read_dic, image_filename, feature_hash
+from utility import optional_import, LRUCache, BackgroundWriter
+from instrument import NullInstrument
+
+# default module of every kind of component
+COMPONENT_MODULES = {
+    'loader': 'loader',
+    'input_filter': 'input_filter',
+    'tokenizer': 'tokenizer',
+    'word_filter': 'word_filter',
+    'stemmer': 'stemmer',
+}
+
+_worker_pipeline = None # analysis components of an indexing worker process
+
+def _filtered_spans(filter_content, content):
+    '''
+    Run the filter method of an input filter over a document. It returns
+    either the text or a list of (text, weight) spans, whose tokens count
+    weight times.
+    '''
+    spans = filter_content(content)
+    if isinstance(spans, basestring):
+        return [(spans, 1)]
+    return spans
+
+def _analyze(pipeline, content):
+    '''
+    Run input filter, tokenizer, word filter and stemmer over a document.
+    Tokens are counted first, so word filter and stemmer run once per
+    distinct token. Return [(token, freq), ...] in order of first
+    occurrence; freq is fractional with fractional weights.
+    '''
+    input_filter, tokenizer, word_filter, stemmer = pipeline
+    word_freq = {}
+    tokens = []
+    for text, weight in _filtered_spans(input_filter.filter, content):
+        for token, count in tokenizer.tokenize_counts(text):
+            token = stemmer.stem(word_filter.filter(token))
+            if not token:
+                continue
+            if token in word_freq:
+                word_freq[token] += count * weight
+            else:
+                word_freq[token] = count * weight
+                tokens.append(token)
+    return [(token, word_freq[token]) for token in tokens]
+
+def _format_tf(value):
+    '''format a term frequency, integral ones without decimals'''
+    if value == int(value):
+        return "%d" % value
+    return "%.12g" % value
+
+def _parse_number(text):
+    '''int or float written in .tf or .corpus'''
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+def _merge_groups(old_groups, new_groups):
+    '''
+    Merge two streams of (tokenid, docids) ascending by tokenid; docids of
+    new_groups all follow those of old_groups.
+    '''
+    old = next(old_groups, None)
+    new = next(new_groups, None)
+    while old is not None or new is not None:
+        if new is None or old is not None and old[0] < new[0]:
+            yield old
+            old = next(old_groups, None)
+        elif old is None or new[0] < old[0]:
+            yield new
+            new = next(new_groups, None)
+        else:
+            yield old[0], old[1] + new[1]
+            old = next(old_groups, None)
+            new = next(new_groups, None)
+
+def _init_worker(pipeline):
+    '''initializer of indexing worker processes'''
+    global _worker_pipeline
+    _worker_pipeline = pipeline
+
+def _analyze_chunk(items):
+    '''analyze a list of (uri, content) items in a worker process'''
+    return [(uri, _analyze(_worker_pipeline, content)) for (uri, content) in items]
 
 class PythonWVTool(object):
     '''Python word vector tool'''
     def __init__(self, taskname, output_folder, loader, input_filter, 
-            tokenizer, word_filter, stemmer, user_dict, encoding='utf8'):
+            tokenizer, word_filter, stemmer, user_dict, encoding='utf8', lexicon='dict'):
         # default config
         self.mindf = 2 # df < mindf will be removed
         self.maxdf = 1000000 # df > maxdf will be removed
+        self.workers = 1 # number of analysis processes, 1 means in-process
+        self.chunksize = 64 # documents sent to a worker at a time
+        self.chunks_ahead = 2 # chunks per worker read and analyzed ahead of indexing
+        self.index_memory = 512 * 1024 * 1024 # bytes of in-memory postings before spilling to disk
+        self.sort_memory = 256 * 1024 * 1024 # bytes of postings buffered per sorted run
+        self.storage = 'text' # 'binary' keeps .tf/.ii/.wv/.docinfo in binformat files (.bin)
+        self.append = False # add documents to the existing task instead of rebuilding it
+        self.memo_size = 262144 # surface forms whose token id is memoized while indexing
+        self.hash_bits = 0 # hash tokens into 2**hash_bits feature ids instead of a lexicon, 0 for none
+        self.signed_hash = False # hashed features get a sign from the hash, colliding counts cancel out
+        self.hash_sample = 0 # one in hash_sample hashed tokens is kept in .hashmap, 0 for none
+        self.max_vocabulary = 0 # distinct tokens kept while indexing, the rarest are evicted beyond; 0 for no cap
+        self.evict_ratio = 0.25 # share of max_vocabulary freed by an eviction
+        self.instrument = NullInstrument() # timers and counters of the run, see instrument.Instrument
+        self.write_buffer = 1024 * 1024 # bytes of .tf/.docinfo handed to the writer thread at a time
+        self.write_interval = 1.0 # seconds after which buffered .tf/.docinfo is handed over anyway
         self.default_encoding = encoding
 
         # parameters
@@ -27,7 +137,7 @@ class PythonWVTool(object):
         self.word_filter = word_filter
         self.stemmer = stemmer
         if user_dict:
-            self.lexicon = {}
+            self.lexicon = DictLexicon()
             with codecs.open(user_dict, 'r', encoding=self.default_encoding, errors='strict') as fdict:
                 for index, line in enumerate(fdict):
                     if isinstance(line, str):
@@ -35,79 +145,340 @@ class PythonWVTool(object):
                     self.lexicon[line.strip()] = index
             self.user_dict = True
         else:
-            self.lexicon = {} # word -> id
-            self.last_tokenid = 0
+            self.lexicon = new_lexicon(lexicon) # word -> id
             self.user_dict = False
 
         # statistics
         self.task_stat = {'document_count':0, 'word_count':0}
         self.doc_stat = {'id':-1, 'uri':'', 'word_freq':{}}
+        self.base_tokenid = 0 # tokens below keep their ids, i.e. those of an appended task
+        self.base_tf_size = 0 # bytes of .tf written before an append
+        self.hash_samples = {} # sampled token -> feature id when hashing
+        self.memo = None # surface form -> (tokenid, sign) while indexing
+        self.doc_freq = {} # tokenid -> df of the live new tokens when the vocabulary is capped
+        self.pruned_postings = {} # tokenid -> [(docid, tf)] of the tokens pruned by mindf, see .pruned
+        self.over_maxdf = set() # tokenids pruned by maxdf, for good as df only grows
+        self.revived_tf = {} # docid -> [(tokenid, tf)] of old documents, tokens an append lifted over mindf
+        self.evicted_tokens = 0
 
     def _filename(self, key):
         '''return full path of specified file'''
         return os.path.join(self.output_folder, "%s.%s" % (self.taskname, key))
 
+    def _count_written(self, key, start=0):
+        '''count the bytes of a task file from offset start on as written'''
+        self.instrument.count('bytes_written', os.path.getsize(self._filename(key)) - start)
+
     def index_corpus(self):
         '''
-        Index the corpus, produce .ii, .tf, .corpus, .docinfo, .dic, etc.
+        Index the corpus, produce .ii, .tf, .corpus, .docinfo, .dic, .pruned, etc.
         '''
+        if self.storage == 'binary' and not optional_import('weighting'):
+            # weighting .tf.bin needs NumPy, fail before indexing rather than after
+            raise NotImplementedError, "binary storage requires NumPy"
         if not os.path.exists(self.output_folder):
             os.mkdir(self.output_folder)
 
-        ftf = open(self._filename('tf'), 'w')
-        fdocinfo = open(self._filename('docinfo'), 'w')
-        ftmp = open(self._filename('tmp'), 'w')
+        if self.hash_bits:
+            if not 0 < self.hash_bits < 32:
+                raise ValueError, "hash bits must be between 1 and 31"
+            if self.user_dict:
+                raise ValueError, "feature hashing does not use a user dict"
+            self.task_stat['hash_bits'] = self.hash_bits
+            self.task_stat['signed_hash'] = int(self.signed_hash)
+        if self.max_vocabulary:
+            if self.user_dict or self.hash_bits:
+                raise ValueError, "the vocabulary cap applies to a lexicon built while indexing"
+            self.task_stat['df_error'] = 0
+        if self.append:
+            self._load_task()
+            ftf = open(self._filename('tf.append'), 'w')
+            fdocinfo = open(self._filename('docinfo'), 'a')
+        else:
+            ftf = open(self._filename('tf'), 'w')
+            fdocinfo = open(self._filename('docinfo'), 'w')
+        # documents are written by background threads, so disk I/O overlaps analysis
+        ftf = BackgroundWriter(ftf, self.write_buffer, self.write_interval)
+        fdocinfo = BackgroundWriter(fdocinfo, self.write_buffer, self.write_interval)
+        postings = Postings(self._filename('tmp'), self.index_memory, self.sort_memory)
 
+        self.memo = LRUCache(self.memo_size)
+        instrument = self.instrument
+        instrument.gauge('lexicon', self.lexicon.__len__)
         self.loader.open()
-        docid = 0
-        for item in self.loader.items():
-            uri, content = item
+        docid = self.task_stat['document_count']
+        for uri, word_freq in self._indexed_items():
             self.doc_stat['id'] = docid
             self.doc_stat['uri'] = uri
-            self.doc_stat['word_freq'] = {}
-            #import pdb; pdb.set_trace()
-            for token in self.tokenizer.tokenize(self.input_filter.filter(content)):
-                token = self.stemmer.stem(self.word_filter.filter(token))
-                if not token:
-                    continue
-                if self.user_dict:
-                    tokenid = self._find_token(token)
-                    if tokenid == -1:
-                        continue # out of user dict
-                else:
-                    tokenid = self._find_update_token(token)
-                # update word statistics
-                self._update_word(tokenid)
-            self._update_doc(ftf, fdocinfo, ftmp)
+            self.doc_stat['word_freq'] = word_freq
+            self._update_doc(ftf, fdocinfo, postings)
+            if self.max_vocabulary and len(self.doc_freq) > self.max_vocabulary:
+                with instrument.timed('evict'):
+                    self._evict(postings)
             docid += 1
+            instrument.document(word_freq)
         self.loader.close()
 
         # close handlers
         ftf.close()
-        ftmp.close()
         fdocinfo.close()
-        # create inverted index from .tmp
-        token_map = self._inverted_index()
+        # create inverted index from the sorted postings
+        with instrument.timed('sort_merge'):
+            token_map = self._inverted_index(postings)
+        postings.close()
         # use new tokenid to output .dic/.tf/.corpus
-        self._update_task(token_map)
+        with instrument.timed('rewrite'):
+            self._update_task(token_map)
+
+    def _load_task(self):
+        '''
+        Load .corpus, .dic and .pruned of the existing task before appending
+        documents. Existing tokens keep their ids and are not pruned again;
+        new tokens are numbered after them. Tokens pruned by df come back
+        from .pruned with their postings, so mindf and maxdf apply to the df
+        over all documents.
+        '''
+        if self.storage == 'binary':
+            raise NotImplementedError, "append mode supports text storage only"
+        stat = {}
+        with open(self._filename('corpus')) as fcorpus:
+            for line in fcorpus:
+                parts = line.strip().split('=')
+                if len(parts) == 2:
+                    stat[parts[0]] = _parse_number(parts[1])
+        if stat.get('hash_bits', 0) != self.hash_bits or \
+                stat.get('signed_hash', 0) != self.task_stat.get('signed_hash', 0):
+            raise ValueError, "feature hashing of the appended task differs"
+        for key in self.task_stat:
+            if key in stat:
+                self.task_stat[key] = stat[key]
+        if self.hash_sample and os.path.exists(self._filename('hashmap')):
+            with open(self._filename('hashmap')) as fmap:
+                for line in fmap: # featureid,token
+                    tid, token = line.rstrip('\n').split(',', 1)
+                    self.hash_samples[token.decode(self.default_encoding)] = int(tid)
+        if not self.user_dict and not self.hash_bits:
+            lexicon = read_dic(self._filename('dic'), self.default_encoding)
+            if isinstance(self.lexicon, HashLexicon) and isinstance(lexicon, DictLexicon):
+                for token, tid in sorted(lexicon.items(), key=lambda x:x[1]):
+                    self.lexicon.add(token)
+            else:
+                self.lexicon = lexicon
+            self.base_tokenid = len(self.lexicon)
+            if not os.path.exists(self._filename('pruned')):
+                raise ValueError, "%s is missing, rebuild the task to append to it" \
+                        % self._filename('pruned')
+            self._load_pruned()
+        self.base_tf_size = os.path.getsize(self._filename('tf'))
+
+    def _load_pruned(self):
+        '''add the tokens of .pruned to the lexicon, after those of .dic'''
+        with open(self._filename('pruned')) as fpruned:
+            for line in fpruned: # docid:tf docid:tf ...<tab>token, or -<tab>token
+                field, token = line.rstrip('\n').split('\t', 1)
+                tid = self.lexicon.add(token.decode(self.default_encoding))
+                if field == '-':
+                    self.over_maxdf.add(tid)
+                    continue
+                pairs = []
+                for part in field.split():
+                    docid, tf = part.split(':')
+                    pairs.append((int(docid), _parse_number(tf)))
+                self.pruned_postings[tid] = pairs
+                if self.max_vocabulary:
+                    self.doc_freq[tid] = len(pairs)
+
+    def _pruned_groups(self):
+        '''generator of (tokenid, docids) of the tokens pruned by mindf before an append'''
+        for tid in sorted(self.pruned_postings):
+            yield tid, array('I', [docid for (docid, tf) in self.pruned_postings[tid]])
+
+    def _old_groups(self):
+        '''generator of (tokenid, docids) of the existing .ii'''
+        with open(self._filename('ii')) as fii:
+            for line in fii: # tokenid,df,docid,docid...
+                parts = line.strip().split(',')
+                yield int(parts[0]), array('I', [int(did) for did in parts[2:]])
+
+    def _analyzed_items(self):
+        '''
+        Generator of (uri, [(token, freq), ...]) in loader order. With more
+        than one worker the documents are analyzed by a process pool, while
+        docids and token ids are still assigned here in the same order as a
+        serial run. At most chunks_ahead chunks per worker are submitted
+        ahead of the one being indexed, so analyzed documents do not pile
+        up when indexing is slower than the workers.
+        '''
+        pipeline = (self.input_filter, self.tokenizer, self.word_filter, self.stemmer)
+        if self.workers <= 1:
+            for uri, content in self.loader.items():
+                yield uri, _analyze(pipeline, content)
+            return
+
+        from multiprocessing import Pool
+        pool = Pool(self.workers, _init_worker, (pipeline,))
+        window = max(self.chunks_ahead * self.workers, 1)
+        try:
+            items = iter(self.loader.items())
+            pending = deque() # results of the submitted chunks, in loader order
+            while True:
+                chunk = list(islice(items, self.chunksize))
+                if chunk:
+                    pending.append(pool.apply_async(_analyze_chunk, (chunk,)))
+                    if len(pending) <= window:
+                        continue
+                elif not pending:
+                    break
+                for result in pending.popleft().get():
+                    yield result
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def _indexed_items(self):
+        '''
+        Generator of (uri, {tokenid: freq}) in loader order. In process the
+        pipeline is fused: the tokens of a document are counted first, then
+        word filter, stemmer and lexicon lookup run once per distinct
+        surface form, through a memo of the surface forms seen recently.
+        Every step is wrapped by the instrument.
+        '''
+        instrument = self.instrument
+        if self.workers > 1:
+            token_id = instrument.wrap('lookup', self._token_id)
+            for uri, token_freq in instrument.wrap_iterator('analyze', self._analyzed_items()):
+                word_freq = {}
+                for token, freq in token_freq:
+                    tokenid, sign = token_id(token)
+                    if tokenid != -1:
+                        word_freq[tokenid] = word_freq.get(tokenid, 0) + sign * freq
+                yield uri, self._nonzero(word_freq)
+            return
+
+        filter_content = instrument.wrap('filter', self.input_filter.filter)
+        tokenize_counts = instrument.wrap('tokenize', self.tokenizer.tokenize_counts)
+        surface_id = instrument.wrap('lookup', self._surface_id)
+        memo = self.memo # tokenid is -1 if dropped
+        for uri, content in instrument.wrap_iterator('load', self.loader.items()):
+            word_freq = {}
+            for text, weight in _filtered_spans(filter_content, content):
+                for surface, count in tokenize_counts(text):
+                    entry = memo.get(surface)
+                    if entry is None:
+                        entry = memo[surface] = surface_id(surface)
+                    tokenid, sign = entry
+                    if tokenid == -1:
+                        continue
+                    if tokenid in word_freq:
+                        word_freq[tokenid] += sign * count * weight
+                    else:
+                        word_freq[tokenid] = sign * count * weight
+            yield uri, self._nonzero(word_freq)
+
+    def _count_df(self, word_freq):
+        '''count the df of the new tokens of a document, for the vocabulary cap'''
+        df = self.doc_freq
+        base = self.base_tokenid
+        for tokenid in word_freq:
+            if tokenid >= base:
+                df[tokenid] = df.get(tokenid, 0) + 1
+
+    def _evict(self, postings):
+        '''
+        Evict the rarest tokens when the vocabulary exceeds max_vocabulary,
+        all whose df is not above a threshold chosen so that at most
+        (1 - evict_ratio) * max_vocabulary remain. Evicted tokens leave the
+        lexicon and their postings are dropped; one seen again starts over
+        with a new id and no df. So a surviving token's df is short by at
+        most the sum of all thresholds, recorded as df_error in .corpus.
+        Tokens of the task appended to are never evicted, those it pruned
+        may be.
+        '''
+        df = self.doc_freq
+        keep = int(self.max_vocabulary * (1 - self.evict_ratio))
+        if len(df) <= keep:
+            return
+        counts = sorted(df.itervalues())
+        threshold = counts[len(counts) - keep - 1]
+        evicted = set([tid for (tid, count) in df.iteritems() if count <= threshold])
+        for tid in evicted:
+            del df[tid]
+        self.evicted_tokens += len(evicted)
+        for tid in evicted:
+            self.pruned_postings.pop(tid, None)
+        self.over_maxdf.difference_update(evicted)
+        self.task_stat['df_error'] += threshold
+        self.lexicon.remove(evicted)
+        postings.discard(evicted)
+        self.memo.clear()
+
+    def _nonzero(self, word_freq):
+        '''drop the features whose signed hashed counts cancelled out'''
+        if not self.signed_hash:
+            return word_freq
+        return dict((tokenid, freq) for (tokenid, freq) in word_freq.iteritems() if freq)
+
+    def _surface_id(self, surface):
+        '''(id, sign) of the token a surface form is filtered and stemmed to, id -1 if dropped'''
+        token = self.stemmer.stem(self.word_filter.filter(surface))
+        if not token:
+            return -1, 1
+        return self._token_id(token)
+
+    def _token_id(self, token):
+        '''
+        (id, sign) of a token, inserted if new; id is -1 if out of the user
+        dict. The sign is 1 unless hashing with signs.
+        '''
+        if self.hash_bits:
+            return self._hash_token(token)
+        if self.user_dict:
+            return self._find_token(token), 1
+        return self._find_update_token(token), 1
+
+    def _hash_token(self, token):
+        '''(feature id, sign) of a hashed token, sampled into the reverse map'''
+        tokenid, sign = feature_hash(token, self.hash_bits, self.signed_hash)
+        if self.hash_sample and token not in self.hash_samples and \
+                adler32(token.encode('utf8')) % self.hash_sample == 0:
+            self.hash_samples[token] = tokenid
+        return tokenid, sign
 
     def create_vector(self, weighting):
         '''create feature vector'''
         if weighting not in ['TF', 'TFIDF']:
             raise NotImplementedError, "Not implemented weighting method %s" % weighting
-        if weighting == 'TF':
-            self._tf()
-        elif weighting == 'TFIDF':
-            self._tfidf()
-        else:
-            pass
+        with self.instrument.timed('weight'):
+            if self.storage == 'binary':
+                self._binary_vector(weighting)
+                self._count_written('wv.bin')
+            elif weighting == 'TF':
+                # rows are only added to .wv after an append
+                path_output = self._filename('wv')
+                start = self.base_tf_size and os.path.exists(path_output) and os.path.getsize(path_output)
+                self._tf()
+                self._count_written('wv', start)
+            elif weighting == 'TFIDF':
+                self._tfidf()
+                self._count_written('wv')
+            else:
+                pass
 
     def _tf(self):
         '''normalized term frequency vector'''
         path_tf = self._filename('tf')
         path_output = self._filename('wv')
-        fd_output = open(path_output, 'w')
+        weighting_engine = optional_import('weighting') # None without NumPy: weight line by line
+        if weighting_engine:
+            weighting_engine.create_vector(path_tf, path_output, offset=self.base_tf_size)
+            return
+        # tf vectors don't depend on other documents: an append only adds rows
+        fd_output = open(path_output, 'a' if self.base_tf_size else 'w')
         with open(path_tf, 'r') as f:
+            f.seek(self.base_tf_size)
             for line in f:
                 line = line.strip()
                 parts = line.split()
@@ -120,7 +491,7 @@ class PythonWVTool(object):
                     subparts = part.split(':')
                     if len(subparts) != 2:
                         continue
-                    wordfreq[int(subparts[0])] = int(subparts[1])
+                    wordfreq[int(subparts[0])] = float(subparts[1])
                     length += float(subparts[1]) * float(subparts[1])
                 length = sqrt(length)
                 sorted_items = wordfreq.items()
@@ -129,20 +500,28 @@ class PythonWVTool(object):
                     ' '.join(["%d:%f" % (k, v/length) for (k, v) in sorted_items])))
         fd_output.close()
 
+    def _doc_count(self):
+        '''read document count from .corpus'''
+        with open(self._filename('corpus')) as f:
+            lines = f.readlines()
+            for line in lines:
+                parts = line.strip().split('=')
+                if len(parts) == 2 and parts[0] == 'document_count':
+                    doc_count = int(parts[1])
+        return doc_count
+
     def _tfidf(self):
         '''normalized td*idf weighting vector'''
         path_tf = self._filename('tf')
         path_ii = self._filename('ii')
-        path_corpus = self._filename('corpus')
         path_output = self._filename('wv')
 
-        # read doc_count
-        with open(path_corpus) as f:
-            lines = f.readlines()
-            for line in lines:
-                parts = line.strip().split('=')
-                if len(parts) == 2 and parts[0] == 'document_count':
-                    doc_count = int(parts[1])
+        doc_count = self._doc_count()
+        weighting_engine = optional_import('weighting')
+        if weighting_engine:
+            idf = weighting_engine.idf_vector(weighting_engine.read_df(path_ii), doc_count)
+            weighting_engine.create_vector(path_tf, path_output, idf)
+            return
         # read df
         token2df = {}
         with open(path_ii) as f:
@@ -165,8 +544,8 @@ class PythonWVTool(object):
                     subparts = part.split(':')
                     if len(subparts) != 2:
                         continue
-                    wordfreq[int(subparts[0])] = int(subparts[1])
-                word_count = float(sum(wordfreq.values()))
+                    wordfreq[int(subparts[0])] = float(subparts[1])
+                word_count = float(sum([abs(v) for v in wordfreq.values()]))
                 length = 0.0
                 for word in wordfreq:
                     if word not in token2df:
@@ -178,60 +557,80 @@ class PythonWVTool(object):
                 sorted_items = wordtfidf.items()
                 sorted_items.sort(key=lambda x:x[0])
                 fd_output.write("%d %s\n" % (docid, 
-                    ' '.join(["%d:%f" % (k, v/length) for (k, v) in sorted_items if v > 1E-5])))
+                    ' '.join(["%d:%f" % (k, v/length) for (k, v) in sorted_items if abs(v) > 1E-5])))
         fd_output.close()
 
-    def _inverted_index(self):
-        '''create inverted index from .tmp file'''
-        filename_sort = self._filename('tmp') + ".sort"
-        cmd = "sort -t, -n -k1,1 -k2,2 -u %s -o %s" \
-                % (self._filename('tmp'), filename_sort)
-        os.system(cmd)
-        lasttid = -1
-        docbin = []
-        token_map = {} # old tokenid -> new tokenid
-        new_token_id = 0
-        fdii = open(self._filename('ii'), 'w')
-        #import pdb; pdb.set_trace()
-        with open(filename_sort) as fd:
-            for line in fd:
-                tid, did = line.strip().split(',')
-                tid = int(tid)
-                did = int(did)
-                if lasttid != -1 and tid != lasttid:
-                    df = len(docbin)
-                    if self.user_dict or df >= self.mindf and df <= self.maxdf:
-                        # when use customized dictionary, token will not be filtered by df
-                        if lasttid not in token_map:
-                            if not self.user_dict:
-                                token_map[lasttid] = new_token_id
-                                new_token_id += 1
-                            else:
-                                token_map[lasttid] = lasttid
-                        docbin.sort()
-                        fdii.write("%s,%d,%s\n" % (token_map[lasttid], len(docbin), ','.join(["%d" % docid for docid in docbin])))
-                        docbin = []
-                    else:
-                        docbin = []
-                docbin.append(did)
-                lasttid = tid
+    def _binary_vector(self, weighting):
+        '''create .wv.bin from .tf.bin (and .ii.bin for TFIDF)'''
+        weighting_engine = optional_import('weighting')
+        if not weighting_engine:
+            raise NotImplementedError, "binary storage requires NumPy"
+        idf = None
+        if weighting == 'TFIDF':
+            idf = weighting_engine.idf_vector(
+                    weighting_engine.read_df_binary(self._filename('ii.bin')), self._doc_count())
+        tf = CSRFile(self._filename('tf.bin'))
+        writer = CSRWriter(self._filename('wv.bin'), 'wv')
+        for block in weighting_engine.weight_blocks(tf.blocks(), idf):
+            writer.add_block(*block)
+        writer.close()
+        tf.close()
+
+    def _inverted_index(self, postings):
+        '''
+        create inverted index from the postings. Hashed feature ids are
+        final and not pruned by df, no token map is returned for them.
+        When appending, the postings of the tokens pruned before are merged
+        in; one now within mindf and maxdf gets an id and its tf is queued
+        for the old .tf rows.
+        '''
+        token_map = None if self.hash_bits else {} # old tokenid -> new tokenid
+        new_token_id = self.base_tokenid
+        groups = postings.groups()
+        if self.append:
+            groups = _merge_groups(chain(self._old_groups(), self._pruned_groups()), groups)
+        if self.storage == 'binary':
+            fdii = CSRWriter(self._filename('ii.bin'), 'ii')
+        else:
+            fdii = open(self._filename('ii') + '.new', 'w')
+        for tid, docids in groups:
+            if self.max_vocabulary and tid >= self.base_tokenid and tid not in self.doc_freq:
+                continue # evicted after its postings were spilled
+            df = len(docids)
+            if self.hash_bits:
+                newtid = tid
+            elif tid < self.base_tokenid:
+                # token of the appended task keeps its id
+                newtid = token_map[tid] = tid
+            elif tid in self.over_maxdf:
+                continue
+            elif self.user_dict or df >= self.mindf and df <= self.maxdf:
+                # when use customized dictionary, token will not be filtered by df
+                if not self.user_dict:
+                    newtid = token_map[tid] = new_token_id
+                    new_token_id += 1
+                    for docid, tf in self.pruned_postings.pop(tid, ()):
+                        self.revived_tf.setdefault(docid, []).append((newtid, tf))
+                else:
+                    newtid = token_map[tid] = tid
+            elif df > self.maxdf:
+                self.over_maxdf.add(tid)
+                self.pruned_postings.pop(tid, None)
+                continue
+            else:
+                # its tf is collected when .tf is rewritten
+                self.pruned_postings.setdefault(tid, [])
+                continue
+            if self.storage == 'binary':
+                fdii.add_row(newtid, docids)
             else:
-                if docbin:
-                    df = len(docbin)
-                    if self.user_dict or df >= self.mindf and df <= self.maxdf:
-                        # when use customized dictionary, token will not be filtered by df
-                        if lasttid not in token_map:
-                            if not self.user_dict:
-                                token_map[lasttid] = new_token_id
-                                new_token_id += 1
-                            else:
-                                token_map[lasttid] = lasttid
-                        docbin.sort()
-                        fdii.write("%s,%d,%s\n" % (token_map[lasttid], len(docbin), ','.join(["%d" % did for did in docbin])))
+                fdii.write("%s,%d,%s\n" % (newtid, df, ','.join(["%d" % did for did in docids])))
         fdii.close()
-        os.remove(self._filename('tmp'))
-        os.remove(filename_sort)
-        #print len(self.lexicon), len(token_map)
+        if self.storage != 'binary':
+            os.rename(self._filename('ii') + '.new', self._filename('ii'))
+            self._count_written('ii')
+        else:
+            self._count_written('ii.bin')
         return token_map
 
     def _find_token(self, token):
@@ -240,54 +639,86 @@ class PythonWVTool(object):
 
     def _find_update_token(self, token):
         '''find id for a token, insert new if not found'''
-        if token in self.lexicon:
-            return self.lexicon[token]
-        else:
-            self.lexicon[token] = self.last_tokenid
-            self.last_tokenid += 1
-            return self.last_tokenid - 1
-
-    def _update_word(self, tokenid):
-        '''update word related stat'''
-        if tokenid in self.doc_stat['word_freq']:
-            self.doc_stat['word_freq'][tokenid] += 1
-        else:
-            self.doc_stat['word_freq'][tokenid] = 1
+        return self.lexicon.add(token)
 
-    def _update_doc(self, ftf, fdocinfo, ftmp):
+    def _update_doc(self, ftf, fdocinfo, postings):
         '''update when a doc is just indexed'''
         self.task_stat['document_count'] += 1
-        ftf.write("%d %s\n" % (self.doc_stat['id'], 
-            " ".join(["%s:%d" % (k, v) for (k, v) in self.doc_stat['word_freq'].items()])))
-        ftf.flush()
-        fdocinfo.write("%d,%s\n" % (self.doc_stat['id'], self.doc_stat['uri']))
-        fdocinfo.flush()
-        ftmp.write('\n'.join(["%d,%d" % (k, self.doc_stat['id']) 
-            for k in self.doc_stat['word_freq']]))
-        if self.doc_stat['word_freq']:
-            ftmp.write('\n')
-        ftmp.flush()
+        if self.max_vocabulary:
+            self._count_df(self.doc_stat['word_freq'])
+        if self.hash_bits:
+            # hashed ids are all kept, so .tf is not rewritten to count them
+            self.task_stat['word_count'] += sum([abs(v) for v in self.doc_stat['word_freq'].itervalues()])
+        tf_line = "%d %s\n" % (self.doc_stat['id'],
+            " ".join(["%s:%s" % (k, _format_tf(v)) for (k, v) in self.doc_stat['word_freq'].items()]))
+        docinfo_line = "%d,%s\n" % (self.doc_stat['id'], self.doc_stat['uri'])
+        ftf.write(tf_line)
+        fdocinfo.write(docinfo_line)
+        self.instrument.count('bytes_written', len(tf_line) + len(docinfo_line))
+        postings.add_doc(self.doc_stat['id'], self.doc_stat['word_freq'])
 
     def _dump_dic(self, token_map):
-        '''dump .dic file'''
-        if self.user_dict or len(token_map) == len(self.lexicon):
+        '''
+        dump .dic file, or add the new tokens to it when appending. A hash
+        lexicon is also saved as an image next to .dic for fast reloads.
+        '''
+        if self.user_dict:
             return
 
-        items = [(token_map[oid], token) for (token, oid) in self.lexicon.items() if oid in token_map]
-        items.sort() # sort by id, token
-        with open(self._filename("dic"), "w") as fdic:
-            fdic.write("%s\n" % ("\n".join(
-                ["%s" %(item[1].encode(self.default_encoding, 'ignore')) for item in items])))
+        items = ((token_map[oid], token) for (token, oid) in self.lexicon.items()
+                if oid in token_map and oid >= self.base_tokenid)
+        image = None
+        if isinstance(self.lexicon, HashLexicon):
+            # items come in id order and token_map keeps that order
+            image = HashLexicon(len(token_map))
+            for tid in xrange(self.base_tokenid):
+                image.add(self.lexicon.token(tid))
+        else:
+            items = sorted(items) # sort by id, token
+        start = self.append and os.path.getsize(self._filename("dic"))
+        with open(self._filename("dic"), "a" if self.append else "w") as fdic:
+            for tid, token in items:
+                fdic.write("%s\n" % token.encode(self.default_encoding, 'ignore'))
+                if image is not None:
+                    image.add(token)
+        self._count_written("dic", start)
+        if image is not None:
+            image.save(image_filename(self._filename("dic")))
+            self.instrument.count('bytes_written', os.path.getsize(image_filename(self._filename("dic"))))
+
+    def _dump_hashmap(self):
+        '''
+        dump the sampled reverse map of hashed features, "featureid,token"
+        per line in featureid order; it includes the samples of the task
+        appended to
+        '''
+        if not self.hash_sample:
+            return
+        items = sorted((tid, token) for (token, tid) in self.hash_samples.iteritems())
+        with open(self._filename("hashmap"), "w") as fmap:
+            for tid, token in items:
+                fmap.write("%d,%s\n" % (tid, token.encode(self.default_encoding, 'ignore')))
+        self._count_written("hashmap")
 
     def _rewrite_tf(self, token_map):
-        '''rewrite the tf file using the token id mapping'''
-        if len(token_map) == len(self.lexicon):
+        '''
+        rewrite the tf file using the token id mapping, or convert it to
+        .tf.bin. Without a token map, i.e. hashed ids, all ids are kept.
+        The tf of the tokens pruned by mindf goes to their postings.
+        '''
+        binary = self.storage == 'binary'
+        if (token_map is None or len(token_map) == len(self.lexicon) and not self.evicted_tokens) \
+                and not binary and not self.append:
             return
 
-        self.task_stat['word_count'] = 0
-        fnnew = self._filename('tf') + ".new"
-        fnew = open(fnnew, 'w')
-        fnold = self._filename('tf')
+        if not self.append and token_map is not None:
+            self.task_stat['word_count'] = 0
+        fnold = self._filename('tf.append' if self.append else 'tf')
+        if binary:
+            fnew = CSRWriter(self._filename('tf.bin'), 'tf')
+        else:
+            fnnew = fnold + ".new"
+            fnew = open(fnnew, 'w')
         with open(fnold) as foldtf:
             for line in foldtf: # docid tokenid:tf tokenid:tf ...
                 parts = line.strip().split()
@@ -296,20 +727,103 @@ class PythonWVTool(object):
                 for part in parts[1:]:
                     subparts = part.split(':')
                     tid = int(subparts[0])
-                    tf = int(subparts[1])
-                    if tid in token_map:
+                    tf = _parse_number(subparts[1])
+                    if token_map is None:
+                        vector.append((tid, tf))
+                    elif tid in token_map:
                         vector.append((token_map[tid], tf))
+                    elif tid in self.pruned_postings:
+                        self.pruned_postings[tid].append((docid, tf))
                 vector.sort()
-                fnew.write("%d %s\n" % (docid, " ".join(["%d:%d" %(k, v) for (k, v) in vector])))
-                self.task_stat['word_count'] += sum([item[1] for item in vector])
+                if binary:
+                    fnew.add_row(docid, [k for (k, v) in vector], [v for (k, v) in vector])
+                else:
+                    fnew.write("%d %s\n" % (docid, " ".join(["%d:%s" %(k, _format_tf(v)) for (k, v) in vector])))
+                if token_map is not None:
+                    self.task_stat['word_count'] += sum([abs(item[1]) for item in vector])
         fnew.close()
         os.remove(fnold)
-        os.rename(fnnew, fnold)
+        if binary:
+            self._count_written('tf.bin')
+        else:
+            self.instrument.count('bytes_written', os.path.getsize(fnnew))
+        if self.append:
+            if self.revived_tf:
+                self._revive_tf()
+            start = os.path.getsize(self._filename('tf'))
+            with open(self._filename('tf'), 'a') as ftf:
+                with open(fnnew) as fappend:
+                    ftf.writelines(fappend)
+            self._count_written('tf', start)
+            os.remove(fnnew)
+        elif not binary:
+            os.rename(fnnew, fnold)
+
+    def _revive_tf(self):
+        '''
+        add the tf of the tokens revived by an append to the old .tf rows;
+        these change, so all rows are weighted again
+        '''
+        fnold = self._filename('tf')
+        with open(fnold) as foldtf:
+            with open(fnold + '.new', 'w') as fnew:
+                for line in foldtf: # docid tokenid:tf tokenid:tf ...
+                    parts = line.split()
+                    docid = int(parts[0])
+                    if docid not in self.revived_tf:
+                        fnew.write(line)
+                        continue
+                    revived = self.revived_tf[docid]
+                    vector = [(int(tid), _parse_number(tf))
+                            for (tid, tf) in (part.split(':') for part in parts[1:])]
+                    vector.extend(revived)
+                    vector.sort()
+                    fnew.write("%d %s\n" % (docid, " ".join(["%d:%s" %(k, _format_tf(v)) for (k, v) in vector])))
+                    self.task_stat['word_count'] += sum([abs(tf) for (tid, tf) in revived])
+        os.rename(fnold + '.new', fnold)
+        self._count_written('tf')
+        self.base_tf_size = 0
+
+    def _dump_pruned(self):
+        '''
+        dump .pruned, the tokens pruned by df for a later append to merge:
+        "docid:tf docid:tf ...<tab>token" per token under mindf,
+        "-<tab>token" per token over maxdf
+        '''
+        with open(self._filename('pruned'), 'w') as fpruned:
+            for token, tid in self.lexicon.items():
+                if tid in self.pruned_postings:
+                    field = " ".join(["%d:%s" % (docid, _format_tf(tf))
+                        for (docid, tf) in self.pruned_postings[tid]])
+                elif tid in self.over_maxdf:
+                    field = '-'
+                else:
+                    continue
+                fpruned.write("%s\t%s\n" % (field, token.encode(self.default_encoding, 'ignore')))
+        self._count_written('pruned')
+
+    def _binary_docinfo(self):
+        '''convert .docinfo to .docinfo.bin'''
+        fbin = CSRWriter(self._filename('docinfo.bin'), 'docinfo')
+        with open(self._filename('docinfo')) as fdocinfo:
+            for line in fdocinfo: # docid,uri
+                docid, uri = line.rstrip('\n').split(',', 1)
+                fbin.add_row(int(docid), uri)
+        fbin.close()
+        os.remove(self._filename('docinfo'))
+        self._count_written('docinfo.bin')
 
     def _update_task(self, token_map):
-        ''' Write .dic, .corpus; rewrite .tf if needed.  '''
-        self._dump_dic(token_map)
+        ''' Write .dic and .pruned (.hashmap when hashing), .corpus; rewrite .tf if needed.  '''
+        if self.hash_bits:
+            self._dump_hashmap()
+        else:
+            self._dump_dic(token_map)
         self._rewrite_tf(token_map)
+        if not self.hash_bits and not self.user_dict:
+            self._dump_pruned()
+        if self.storage == 'binary':
+            self._binary_docinfo()
         self._dump_corpus()
 
     def _dump_corpus(self):
@@ -317,6 +831,7 @@ class PythonWVTool(object):
         with open(self._filename('corpus'), 'w') as fcorpus:
             fcorpus.write("%s\n" 
                     % ("\n".join("%s=%s" % (k,v) for (k,v) in self.task_stat.items())))
+        self._count_written('corpus')
 
 def getopts():
     '''parse options'''
@@ -353,6 +868,38 @@ def getopts():
             help="Weighting method, default TFIDF")
     parser.add_option("-u", "--user-dict", dest="user_dict", default="",
             help="path to user dict file, format id,term")
+    parser.add_option("", "--workers", dest="workers", type="int", default=1,
+            help="number of indexing processes, default 1")
+    parser.add_option("", "--index-memory", dest="index_memory", type="int", default=512,
+            help="MB of postings indexed in memory before switching to sorted runs on disk, default 512")
+    parser.add_option("", "--sort-memory", dest="sort_memory", type="int", default=256,
+            help="MB of postings buffered per sorted run on disk, default 256")
+    parser.add_option("", "--memo-size", dest="memo_size", type="int", default=262144,
+            help="surface forms whose token id is memoized while indexing, default 262144")
+    parser.add_option("", "--hash-bits", dest="hash_bits", type="int", default=0,
+            help="hash tokens into 2^N feature ids instead of building .dic, default 0 (no hashing)")
+    parser.add_option("", "--signed-hash", action='store_true', dest="signed_hash", default=False,
+            help="give hashed features a sign from the hash to offset collisions")
+    parser.add_option("", "--hash-sample", dest="hash_sample", type="int", default=0,
+            help="keep one in N hashed tokens in .hashmap for debugging, default 0 (none)")
+    parser.add_option("", "--max-vocabulary", dest="max_vocabulary", type="int", default=0,
+            help="cap the distinct tokens kept while indexing by evicting the rarest, default 0 (no cap)")
+    parser.add_option("-s", "--storage", dest="storage", default="text",
+            help="storage of .tf/.ii/.wv/.docinfo: text or binary, default text")
+    parser.add_option("", "--lexicon", dest="lexicon", default="dict",
+            help="lexicon backend: dict or hash (compact, saved as .lex), default dict")
+    parser.add_option("-a", "--append", action='store_true', dest="append", default=False,
+            help="append the documents to the existing task instead of rebuilding it")
+    parser.add_option("", "--timing", action='store_true', dest="timing", default=False,
+            help="print import and startup time of every component to stderr")
+    parser.add_option("", "--stats", action='store_true', dest="stats", default=False,
+            help="time every step, log progress to stderr and write a JSON summary to .stats")
+    parser.add_option("", "--stats-sample", dest="stats_sample", type="int", default=100,
+            help="time one in N calls of every pipeline component with --stats, default 100")
+    parser.add_option("", "--progress", dest="progress", type="float", default=10,
+            help="seconds between progress lines with --stats, 0 for none, default 10")
+    parser.add_option("", "--profile-sample", dest="profile_sample", type="int", default=0,
+            help="profile one in N documents with cProfile into .prof, implies --stats, default 0 (none)")
     parser.add_option("-p", "--psyco", action='store_true', 
                     dest="psyco", default=False,
                     help="to enable psyco")
@@ -365,6 +912,35 @@ def getopts():
         psyco.full()
     return options
 
+def _component_class(kind, name):
+    '''(module name, class name) of a component, name is a class of the default module or "module.ClassName"'''
+    if '.' in name:
+        return tuple(name.rsplit('.', 1))
+    return COMPONENT_MODULES[kind], name
+
+def load_component(kind, name, params):
+    '''
+    Construct a component by name. Only the module of the chosen class is
+    imported, and components defer loading their resources to first use.
+    '''
+    module_name, class_name = _component_class(kind, name)
+    module = __import__(module_name, fromlist=[class_name])
+    if not hasattr(module, class_name):
+        raise NotImplementedError, "Not implemented %s %s" % (kind, name)
+    return getattr(module, class_name)(params)
+
+def _timed_component(kind, name, params):
+    '''load_component, printing import and construction time to stderr'''
+    from time import time
+    start = time()
+    __import__(_component_class(kind, name)[0])
+    imported = time()
+    component = load_component(kind, name, params)
+    created = time()
+    print >> sys.stderr, "%-12s %-24s import %.3fs init %.3fs" % (
+            kind, name, imported - start, created - imported)
+    return component
+
 def main():
     '''main entry'''
     from utility import param_adapter
@@ -376,36 +952,37 @@ def main():
     weighting = options.weighting.upper()
     user_dict = options.user_dict
     encoding = options.encoding
-    if options.loader in globals():
-        loader = globals()[options.loader](param_adapter(options.loader_op))
-    else:
-        module = __import__('loader') # default module
-        loader = getattr(module, options.loader)(param_adapter(options.loader_op))
-    if options.input_filter in globals():
-        input_filter = globals()[options.input_filter](param_adapter(options.input_filter_op))
-    else:
-        module = __import__('input_filter') # default module
-        input_filter = getattr(module, options.input_filter)(param_adapter(options.input_filter_op))
-    if options.tokenizer in globals():
-        tokenizer = globals()[options.tokenizer](param_adapter(options.tokenizer_op))
-    else:
-        module = __import__('tokenizer') # default module
-        tokenizer = getattr(module, options.tokenizer)(param_adapter(options.tokenizer_op))
-    if options.word_filter in globals():
-        word_filter = globals()[options.word_filter](param_adapter(options.word_filter_op))
-    else:
-        module = __import__('word_filter') # default module
-        word_filter = getattr(module, options.word_filter)(param_adapter(options.word_filter_op))
-    if options.stemmer in globals():
-        stemmer = globals()[options.stemmer](param_adapter(options.stemmer_op))
-    else:
-        module = __import__('stemmer') # default module
-        stemmer = getattr(module, options.stemmer)(param_adapter(options.stemmer_op))
+    create = _timed_component if options.timing else load_component
+    loader = create('loader', options.loader, param_adapter(options.loader_op))
+    input_filter = create('input_filter', options.input_filter, param_adapter(options.input_filter_op))
+    tokenizer = create('tokenizer', options.tokenizer, param_adapter(options.tokenizer_op))
+    word_filter = create('word_filter', options.word_filter, param_adapter(options.word_filter_op))
+    stemmer = create('stemmer', options.stemmer, param_adapter(options.stemmer_op))
+    if options.timing:
+        # resources loaded lazily, e.g. segmentation dictionaries, are loaded on the first call
+        from time import time
+        start = time()
+        list(tokenizer.tokenize(u''))
+        print >> sys.stderr, "%-12s %-24s first call %.3fs" % ('tokenizer', options.tokenizer, time() - start)
 
     pywvtool = PythonWVTool(taskname, output_folder, loader, input_filter, 
-            tokenizer, word_filter, stemmer, user_dict, encoding)
+            tokenizer, word_filter, stemmer, user_dict, encoding, options.lexicon)
+    pywvtool.workers = options.workers
+    pywvtool.index_memory = options.index_memory * 1024 * 1024
+    pywvtool.sort_memory = options.sort_memory * 1024 * 1024
+    pywvtool.memo_size = options.memo_size
+    pywvtool.hash_bits = options.hash_bits
+    pywvtool.signed_hash = options.signed_hash
+    pywvtool.hash_sample = options.hash_sample
+    pywvtool.max_vocabulary = options.max_vocabulary
+    pywvtool.storage = options.storage.lower()
+    pywvtool.append = options.append
+    if options.stats or options.profile_sample:
+        from instrument import Instrument
+        pywvtool.instrument = Instrument(options.stats_sample, options.progress, options.profile_sample)
     pywvtool.index_corpus()
     pywvtool.create_vector(weighting)
+    pywvtool.instrument.dump(pywvtool._filename('stats'))
 
 if __name__ == "__main__":
     main()
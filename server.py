@@ -0,0 +1,298 @@
+#!/usr/local/bin/python
+#encoding:utf8
+'''
+Vectorization service. Loads a finished task once, its .dic (unless its
+tokens are hashed), df from .ii and document count and feature hashing
+settings from .corpus, together with the analysis pipeline, and
+turns raw texts into weighted vectors over HTTP. Weights are computed by
+the weighting engine used offline, so a text gets the vector it would get
+in the task's .wv.
+
+    POST /vectorize  {"texts": [text, ...]}
+                     -> {"vectors": [[[tokenid, weight], ...], ...]}
+    POST /wv         one text per line -> .wv lines, docid is the line number
+
+Concurrent requests are batched: a single thread analyzes and weights all
+texts queued within a short delay in one pass.
+'''
+from __future__ import with_statement
+import sys
+import os
+import json
+import threading
+import Queue
+from time import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import numpy
+import weighting
+from lexicon import read_dic, feature_hash
+from pywvtool import _analyze, load_component
+
+class Vectorizer(object):
+    '''analysis pipeline, lexicon and df of a finished task'''
+    def __init__(self, output_folder, taskname, pipeline, weighting_method='TFIDF',
+            user_dict='', encoding='utf8'):
+        self.output_folder = output_folder
+        self.taskname = taskname
+        self.pipeline = pipeline
+        stat = self._corpus_stat()
+        self.doc_count = stat.get('document_count', 0)
+        self.hash_bits = stat.get('hash_bits', 0)
+        self.signed_hash = bool(stat.get('signed_hash', 0))
+        self.lexicon = None
+        if not self.hash_bits:
+            self.lexicon = read_dic(user_dict or self._filename('dic'), encoding)
+        if os.path.exists(self._filename('ii.bin')):
+            self.df = weighting.read_df_binary(self._filename('ii.bin'))
+        else:
+            self.df = weighting.read_df(self._filename('ii'))
+        if weighting_method == 'TF':
+            self.idf = None
+        elif weighting_method == 'TFIDF':
+            self.idf = weighting.idf_vector(self.df, self.doc_count)
+        else:
+            raise NotImplementedError, "Not implemented weighting %s" % weighting_method
+
+    def _filename(self, key):
+        '''return full path of specified file'''
+        return os.path.join(self.output_folder, "%s.%s" % (self.taskname, key))
+
+    def _corpus_stat(self):
+        '''read the integer statistics of .corpus'''
+        stat = {}
+        with open(self._filename('corpus')) as f:
+            for line in f:
+                parts = line.strip().split('=')
+                if len(parts) == 2 and parts[1].isdigit():
+                    stat[parts[0]] = int(parts[1])
+        return stat
+
+    def _features(self, token_freq):
+        '''[(tokenid, freq), ...] of the analyzed tokens that are features of the task'''
+        df = self.df
+        features = []
+        if self.hash_bits:
+            feature_freq = {}
+            for token, freq in token_freq:
+                tid, sign = feature_hash(token, self.hash_bits, self.signed_hash)
+                feature_freq[tid] = feature_freq.get(tid, 0) + sign * freq
+            token_freq = [(tid, freq) for (tid, freq) in feature_freq.iteritems() if freq]
+        for token, freq in token_freq:
+            tid = token if self.hash_bits else self.lexicon.get(token, -1)
+            # the task's .tf only keeps tokens that survived df pruning
+            if 0 <= tid < len(df) and df[tid] > 0:
+                features.append((tid, freq))
+        return features
+
+    def vectorize(self, texts):
+        '''weighted vectors of texts, [(indices, weights), ...] of NumPy arrays'''
+        indptr = [0]
+        indices = []
+        data = []
+        for text in texts:
+            for tid, freq in self._features(_analyze(self.pipeline, text)):
+                indices.append(tid)
+                data.append(freq)
+            indptr.append(len(indices))
+        block = (numpy.arange(len(texts)), numpy.array(indptr, dtype=numpy.int64),
+                numpy.array(indices, dtype=numpy.int64), numpy.array(data, dtype=numpy.float64))
+        empty = (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.float64))
+        vectors = [empty] * len(texts)
+        for docids, indptr, indices, data in weighting.weight_blocks([block], self.idf):
+            for i, docid in enumerate(docids.tolist()):
+                vectors[docid] = (indices[indptr[i]:indptr[i+1]], data[indptr[i]:indptr[i+1]])
+        return vectors
+
+def wv_lines(vectors):
+    '''format vectors as .wv lines, docid is the position; empty vectors are skipped like in .wv'''
+    rows = [(docid, vector) for (docid, vector) in enumerate(vectors) if len(vector[0])]
+    if not rows:
+        return []
+    indptr = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(vector[0]) for (docid, vector) in rows], out=indptr[1:])
+    return weighting.format_rows((numpy.array([docid for (docid, vector) in rows]), indptr,
+        numpy.concatenate([vector[0] for (docid, vector) in rows]),
+        numpy.concatenate([vector[1] for (docid, vector) in rows])))
+
+class _Request(object):
+    '''texts of a request waiting for their vectors'''
+    def __init__(self, texts):
+        self.texts = texts
+        self.vectors = None
+        self.error = None
+        self.done = threading.Event()
+
+class Batcher(object):
+    '''
+    Runs a vectorizer in a single thread, so components need not be thread
+    safe. Requests queued while a batch is collected, up to max_batch texts
+    or max_delay seconds after the first one, are vectorized together.
+    '''
+    def __init__(self, vectorizer, max_batch=256, max_delay=0.005):
+        self.vectorizer = vectorizer
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def vectorize(self, texts):
+        '''vectors of texts, blocking until their batch is done'''
+        request = _Request(texts)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.vectors
+
+    def _collect(self):
+        '''wait for a request and gather the requests following it into a batch'''
+        batch = [self._queue.get()]
+        size = len(batch[0].texts)
+        deadline = time() + self.max_delay
+        while size < self.max_batch:
+            timeout = deadline - time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(True, timeout)
+            except Queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.texts)
+        return batch
+
+    def _run(self):
+        '''batch loop'''
+        while True:
+            batch = self._collect()
+            try:
+                texts = []
+                for request in batch:
+                    texts.extend(request.texts)
+                vectors = self.vectorizer.vectorize(texts)
+                start = 0
+                for request in batch:
+                    request.vectors = vectors[start:start + len(request.texts)]
+                    start += len(request.texts)
+            except Exception, e:
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+class VectorHandler(BaseHTTPRequestHandler):
+    '''HTTP interface of a Batcher'''
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        try:
+            if self.path == '/vectorize':
+                texts = json.loads(body)['texts']
+                if not isinstance(texts, list):
+                    raise TypeError, "texts must be a list"
+                # a bad text would fail the whole batch it joins
+                for text in texts:
+                    if not isinstance(text, basestring):
+                        raise TypeError, "texts must be strings"
+                vectors = self.server.batcher.vectorize(texts)
+                response = json.dumps({'vectors': [zip(indices.tolist(), weights.tolist())
+                    for (indices, weights) in vectors]})
+                content_type = 'application/json'
+            elif self.path == '/wv':
+                texts = body.decode(self.server.encoding, 'ignore').splitlines()
+                response = ''.join(wv_lines(self.server.batcher.vectorize(texts)))
+                content_type = 'text/plain'
+            else:
+                self.send_error(404)
+                return
+        except (ValueError, KeyError, TypeError), e:
+            self.send_error(400, str(e))
+            return
+        except Exception, e:
+            self.send_error(500, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass # no log line per request
+
+class VectorServer(ThreadingMixIn, HTTPServer):
+    '''threaded HTTP server, every request waits on the shared batcher'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, batcher, encoding='utf8'):
+        HTTPServer.__init__(self, address, VectorHandler)
+        self.batcher = batcher
+        self.encoding = encoding
+
+def getopts():
+    '''parse options'''
+    from optparse import OptionParser
+    usage = "serve word vectors of raw texts for a finished task"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-t", "--taskname", dest="taskname", default="",
+            help="name of task") # required
+    parser.add_option("-o", "--output-folder", dest="output_folder", default="",
+            help="output folder of the task") # required
+    parser.add_option("-e", "--encoding", dest="encoding", default="utf8",
+            help="default system encoding, utf8 by default")
+    parser.add_option("", "--input-filter", dest="input_filter", default="DummyInputFilter",
+            help="InputFilter's name, default DummyInputFilter")
+    parser.add_option("", "--input-filter-op", dest="input_filter_op", default="",
+            help="InputFilter's option, default empty")
+    parser.add_option("", "--tokenizer", dest="tokenizer", default="CharTokenizer",
+            help="Tokenizer's name, default CharTokenizer")
+    parser.add_option("", "--tokenizer-op", dest="tokenizer_op", default="",
+            help="Tokenizer's option, default empty")
+    parser.add_option("", "--word-filter", dest="word_filter", default="DummyWordFilter",
+            help="WordFilter's name, default DummyWordFilter")
+    parser.add_option("", "--word-filter-op", dest="word_filter_op", default="",
+            help="WordFilter's option, default empty")
+    parser.add_option("", "--stemmer", dest="stemmer", default="DummyStemmer",
+            help="Stemmer's name, default DummyStemmer")
+    parser.add_option("", "--stemmer-op", dest="stemmer_op", default="",
+            help="Stemmer's option, default empty")
+    parser.add_option("-w", "--weighting", dest="weighting", default="TFIDF",
+            help="Weighting method, default TFIDF")
+    parser.add_option("-u", "--user-dict", dest="user_dict", default="",
+            help="user dict the task was indexed with")
+    parser.add_option("", "--host", dest="host", default="127.0.0.1",
+            help="address to listen on, default 127.0.0.1")
+    parser.add_option("", "--port", dest="port", type="int", default=8080,
+            help="port to listen on, default 8080")
+    parser.add_option("", "--batch-size", dest="batch_size", type="int", default=256,
+            help="max texts vectorized in one batch, default 256")
+    parser.add_option("", "--batch-delay", dest="batch_delay", type="float", default=5,
+            help="ms to wait for more requests to batch, default 5")
+    options = parser.parse_args()[0]
+    if not (options.taskname and options.output_folder):
+        print "Syntax error, please type -h to see usage."
+        sys.exit(-1)
+    return options
+
+def main():
+    '''main entry'''
+    from utility import param_adapter
+    options = getopts()
+    pipeline = (
+        load_component('input_filter', options.input_filter, param_adapter(options.input_filter_op)),
+        load_component('tokenizer', options.tokenizer, param_adapter(options.tokenizer_op)),
+        load_component('word_filter', options.word_filter, param_adapter(options.word_filter_op)),
+        load_component('stemmer', options.stemmer, param_adapter(options.stemmer_op)),
+    )
+    vectorizer = Vectorizer(options.output_folder, options.taskname, pipeline,
+            options.weighting.upper(), options.user_dict, options.encoding)
+    vectorizer.vectorize([u'']) # load lazy resources before the first request
+    batcher = Batcher(vectorizer, options.batch_size, options.batch_delay / 1000.0)
+    server = VectorServer((options.host, options.port), batcher, options.encoding)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
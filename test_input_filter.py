@@ -0,0 +1,52 @@
+#!/usr/local/bin/python
+#encoding:utf8
+'''
+Regression tests of the single pass HTML scanner of input_filter.
+
+    python -m unittest test_input_filter
+'''
+import unittest
+from time import time
+from input_filter import html_to_text, TagWeightingFilter
+
+class HtmlToTextTest(unittest.TestCase):
+    def test_apostrophe_in_unquoted_value(self):
+        self.assertEqual(html_to_text(u"<p title=don't>Hello</p> world <b>it's</b> fine"),
+                u"\nHello\n world it's fine")
+
+    def test_apostrophe_in_unquoted_alt(self):
+        self.assertEqual(html_to_text(u"<img alt=O'Reilly src=x.png>Book about <i>Python</i>"),
+                u'Book about Python')
+
+    def test_quoted_value_with_gt(self):
+        self.assertEqual(html_to_text(u'<a title="a > b" href=\'c>d\'>link</a> text'), u'link text')
+
+    def test_unclosed_quote_ends_at_next_gt(self):
+        self.assertEqual(html_to_text(u'<a title="open>link</a> text'), u'link text')
+
+    def test_lt_that_starts_no_tag_is_text(self):
+        text = u'if a<b then c, 1 < 2 and x<y'
+        self.assertEqual(html_to_text(text), text)
+        self.assertEqual(html_to_text(u'<p>a <3 b</p>'), u'\na <3 b\n')
+
+    def test_skipped_elements(self):
+        html = (u'<!DOCTYPE html><html><head><title>T</title><style>p {}</style></head>'
+                u'<body><!-- note --><script>var a = "<p>";</script><p>Body &amp; text</p></body></html>')
+        self.assertEqual(html_to_text(html), u'\n\n\nBody & text\n\n\n')
+
+    def test_unclosed_lt_is_linear(self):
+        for html in (u'if a<b then c ' * 20000, u'<a href=x text ' * 20000,
+                u'<p class="a ' * 20000, u'<!x ' * 20000, u'<head>x' * 20000):
+            start = time()
+            html_to_text(html)
+            self.assertTrue(time() - start < 5, 'quadratic scan of %r...' % html[:16])
+
+class TagWeightingFilterTest(unittest.TestCase):
+    def test_weights(self):
+        spans = TagWeightingFilter({}).filter(
+                u"<title>T</title><h1 title=don't>Head</h1><p>body <a href='x'>link</a></p>")
+        self.assertEqual(spans, [(u'\n', 1), (u'T\n', 3), (u'\n', 1), (u'Head\n', 2),
+                (u'\nbody ', 1), (u'link', 1.5), (u'\n', 1)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/local/bin/python
+#encoding:utf8
+'''
+Tests of UrlListLoader against a web server on localhost.
+
+    python -m unittest test_loader
+'''
+import os
+import gzip
+import shutil
+import tempfile
+import threading
+import unittest
+from time import sleep
+from StringIO import StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from loader import UrlListLoader
+
+def _gzip(content):
+    '''content compressed as by Content-Encoding: gzip'''
+    buf = StringIO()
+    fgz = gzip.GzipFile(fileobj=buf, mode='wb')
+    fgz.write(content)
+    fgz.close()
+    return buf.getvalue()
+
+class _Handler(BaseHTTPRequestHandler):
+    '''pages of the tests, /page/N answers later the smaller N is'''
+    protocol_version = 'HTTP/1.1' # keep-alive, as the loader expects
+
+    def do_GET(self):
+        headers = {'Content-Type': 'text/html'}
+        if self.path.startswith('/page/'):
+            number = int(self.path[len('/page/'):])
+            sleep(max(0, 5 - number) * 0.05)
+            status, body = 200, 'page %d' % number
+        elif self.path == '/redirect':
+            status, body = 302, ''
+            headers['Location'] = '/page/9'
+        elif self.path == '/latin1':
+            status, body = 200, '<html><head><meta charset="iso-8859-1"></head><body>caf\xe9</body></html>'
+        elif self.path == '/gzip':
+            status, body = 200, _gzip('compressed page')
+            headers['Content-Encoding'] = 'gzip'
+        else:
+            status, body = 404, 'not found'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class UrlListLoaderTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = _Server(('127.0.0.1', 0), _Handler)
+        cls.base = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _load(self, urls, **params):
+        '''[(url, content)] loaded from a list of urls'''
+        path = os.path.join(self.folder, 'urls')
+        with open(path, 'w') as furls:
+            furls.write(''.join('%s\n' % url for url in urls))
+        params['src'] = path
+        loader = UrlListLoader(params)
+        loader.open()
+        try:
+            return list(loader.items())
+        finally:
+            loader.close()
+
+    def test_order_of_the_list(self):
+        urls = ['%s/page/%d' % (self.base, number) for number in range(6)]
+        items = self._load(urls, workers='6')
+        self.assertEqual(items, [(url, u'page %d' % number) for (number, url) in enumerate(urls)])
+
+    def test_redirect(self):
+        self.assertEqual(self._load([self.base + '/redirect']),
+                [(self.base + '/redirect', u'page 9')])
+
+    def test_not_found_is_skipped(self):
+        urls = [self.base + '/page/1', self.base + '/missing', self.base + '/page/2']
+        self.assertEqual([url for (url, content) in self._load(urls)], [urls[0], urls[2]])
+
+    def test_meta_charset(self):
+        [(url, content)] = self._load([self.base + '/latin1'])
+        self.assertTrue(u'caf\xe9' in content)
+
+    def test_gzip(self):
+        self.assertEqual(self._load([self.base + '/gzip']), [(self.base + '/gzip', u'compressed page')])
+
+    def test_unreachable_host_is_skipped(self):
+        urls = ['http://127.0.0.1:1/', self.base + '/page/3']
+        self.assertEqual(self._load(urls, retries='0', timeout='2'), [(urls[1], u'page 3')])
+
+if __name__ == '__main__':
+    unittest.main()
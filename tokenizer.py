@@ -3,8 +3,14 @@
 '''
 Tokenizer interface and some default classes.
 '''
+import re
 from utility import check_required_params
 
+# runs of alnum characters: \w without the underscore is exactly
+# unicode.isalnum(), and str.isalnum() of the C locale for byte strings
+_CHUNK_UNICODE = re.compile(r'[^\W_]+', re.UNICODE)
+_CHUNK_BYTES = re.compile(r'[^\W_]+')
+
 class Tokenizer(object):
     def __init__(self, params=None):
         pass
@@ -12,26 +18,31 @@ class Tokenizer(object):
     def tokenize(self, stream):
         raise NotImplementedError
 
+    def tokenize_counts(self, stream):
+        '''list of (token, count) of the distinct tokens in order of first occurrence'''
+        tokens = self.tokenize(stream)
+        if not isinstance(tokens, list):
+            tokens = list(tokens)
+        counts = {}
+        get = counts.get
+        for token in tokens:
+            counts[token] = get(token, 0) + 1
+        if len(counts) == len(tokens):
+            return [(token, 1) for token in tokens]
+        distinct = []
+        for token in tokens:
+            count = counts.get(token)
+            if count is not None:
+                distinct.append((token, count))
+                del counts[token]
+        return distinct
+
 class ChunkTokenizer(Tokenizer):
     '''Split input stream into pieces delimitered by punctions, i.e. sub-sentence level'''
     def tokenize(self, stream):
-        p = 0 
-        q = 0
-        size = len(stream)
-        while True:
-            # skip non alnum
-            while p < size and not stream[p].isalnum():
-                p += 1
-
-            if p == size:
-                break
-
-            # read until a non-alnum
-            q = p
-            while p < size and stream[p].isalnum():
-                p += 1
-            chunk = stream[q:p]
-            yield chunk
+        if isinstance(stream, unicode):
+            return _CHUNK_UNICODE.findall(stream)
+        return _CHUNK_BYTES.findall(stream)
 
 class NGramTokenizer(Tokenizer):
     '''Emit n-grams based on chunks'''
@@ -46,10 +57,16 @@ class NGramTokenizer(Tokenizer):
         self._imp_tokenizer = ChunkTokenizer()
 
     def tokenize(self, stream):
-        for chunk in self._imp_tokenizer.tokenize(stream):
-            size = len(chunk)
-            for i in range(size-self.n+1):
-                yield chunk[i:i+self.n]
+        chunks = self._imp_tokenizer.tokenize(stream)
+        n = self.n
+        if n == 1:
+            # unigrams are the characters of the chunks
+            return list(stream[:0].join(chunks))
+        ngrams = []
+        for chunk in chunks:
+            if len(chunk) >= n:
+                ngrams.extend([chunk[i:i+n] for i in xrange(len(chunk)-n+1)])
+        return ngrams
 
 class CharTokenizer(NGramTokenizer):
     def __init__(self, params):
@@ -84,10 +101,11 @@ class MMSegTokenizer(Tokenizer):
 
     def tokenize(self, stream):
         import mmseg
-        for chunk in self._imp_tokenizer.tokenize(stream):
-            r = mmseg.seg_txt(chunk.encode('utf8', 'ignore'))
-            for word in r:
-                yield word.decode('utf8', 'ignore')
+        # segment all chunks in one call, spans are character offsets into each chunk
+        chunks = self._imp_tokenizer.tokenize(stream)
+        return [chunk[start:end]
+                for chunk, spans in zip(chunks, mmseg.segment_many(chunks))
+                for (start, end) in spans]
 
 if __name__ == "__main__":
     #import pdb; pdb.set_trace()
@@ -3,6 +3,13 @@
 '''
 Utility functions for all components.
 '''
+from __future__ import with_statement
+import sys
+import threading
+import Queue
+from time import time
+
+_missing = set() # optional modules that failed to import
 
 def check_required_params(keys, params):
     '''check required keys'''
@@ -28,3 +35,231 @@ def param_adapter(param_string):
                 k, v = subpart
                 d[k] = v
         return d
+
+def optional_import(name):
+    '''
+    Import a module on first use instead of at startup. Return None if it
+    cannot be imported, e.g. an optional dependency that is not installed.
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    if name in _missing:
+        return None
+    try:
+        __import__(name)
+    except ImportError:
+        _missing.add(name)
+        return None
+    return sys.modules[name]
+
+def ordered_map(func, items, workers=8, window=None):
+    '''
+    Generator of func(item) for every item, computed by a pool of worker
+    threads and yielded in the order of items. At most window items (4 per
+    worker by default) are taken from items ahead of the consumer, so long
+    or unbounded inputs run in bounded memory. An exception raised by func
+    is re-raised when its item's turn comes.
+    '''
+    window = window or 4 * workers
+    tasks = Queue.Queue()
+    slots = threading.Semaphore(window) # items taken but not yet yielded
+    done = threading.Condition()
+    results = {} # index -> (ok, value)
+    state = {'total': None, 'error': None, 'stopped': False}
+
+    def produce():
+        count = 0
+        try:
+            for item in items:
+                slots.acquire()
+                if state['stopped']:
+                    break
+                tasks.put((count, item))
+                count += 1
+        except Exception, e:
+            state['error'] = e
+        for i in range(workers):
+            tasks.put(None)
+        with done:
+            state['total'] = count
+            done.notify()
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            index, item = task
+            try:
+                result = (True, func(item))
+            except Exception, e:
+                result = (False, e)
+            with done:
+                results[index] = result
+                done.notify()
+
+    threads = [threading.Thread(target=produce)] + \
+            [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    try:
+        index = 0
+        while True:
+            with done:
+                while index not in results and state['total'] != index:
+                    done.wait()
+                if index not in results:
+                    break # all items yielded
+                ok, value = results.pop(index)
+            slots.release()
+            if not ok:
+                raise value
+            yield value
+            index += 1
+        if state['error'] is not None:
+            raise state['error']
+    finally:
+        # when the consumer leaves early stop the producer, drop pending
+        # items and wait for the items in progress
+        state['stopped'] = True
+        for i in range(window):
+            slots.release()
+        threads[0].join()
+        try:
+            while True:
+                tasks.get_nowait()
+        except Queue.Empty:
+            pass
+        for i in range(workers):
+            tasks.put(None)
+        for thread in threads[1:]:
+            thread.join()
+
+class LRUCache(object):
+    '''
+    Bounded memo that forgets the least recently used key when full. Keys
+    are kept in a circular doubly linked list of [prev, next, key, value]
+    links, oldest first after the root.
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._links = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def get(self, key, default=None):
+        '''value of a key, now the most recently used, default if absent'''
+        link = self._links.get(key)
+        if link is None:
+            return default
+        prev, next, key, value = link
+        prev[1] = next
+        next[0] = prev
+        root = self._root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._links:
+            self._links[key][3] = value
+            self.get(key)
+            return
+        if self.capacity <= 0:
+            return
+        root = self._root
+        if len(self._links) >= self.capacity:
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self._links[oldest[2]]
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = root[0] = link
+        self._links[key] = link
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def __len__(self):
+        return len(self._links)
+
+    def clear(self):
+        '''forget all keys'''
+        self._links.clear()
+        self._root[:] = [self._root, self._root, None, None]
+
+class BackgroundWriter(object):
+    '''
+    Write to a file from a background thread in large chunks. Written text
+    is buffered and handed to the thread once buffer_size bytes are
+    buffered or interval seconds passed since the last hand-over, through a
+    queue of at most max_pending chunks, so a slow disk blocks the writer
+    instead of filling memory. An error of the thread is raised by the next
+    call.
+    '''
+    def __init__(self, fileobj, buffer_size=1024*1024, interval=1.0, max_pending=8):
+        self.buffer_size = buffer_size
+        self.interval = interval
+        self._file = fileobj
+        self._parts = []
+        self._size = 0
+        self._last = time()
+        self._error = None
+        self._queue = Queue.Queue(max_pending)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def write(self, text):
+        '''buffer text, handing the buffer over when a threshold is reached'''
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_size or time() - self._last >= self.interval:
+            self._hand_over()
+
+    def _hand_over(self):
+        '''queue the buffered text for the thread'''
+        if self._error is not None:
+            raise self._error
+        if self._parts:
+            self._queue.put(''.join(self._parts))
+            self._parts = []
+            self._size = 0
+        self._last = time()
+
+    def _run(self):
+        '''write queued chunks until None'''
+        while True:
+            chunk = self._queue.get()
+            try:
+                if chunk is None:
+                    break
+                if self._error is None: # after an error only drain the queue
+                    self._file.write(chunk)
+            except Exception, e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        '''write out everything written so far'''
+        self._hand_over()
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+        self._file.flush()
+
+    def close(self):
+        '''write out everything, stop the thread and close the file'''
+        try:
+            self._hand_over()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self._file.close()
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,151 @@
+#!/usr/local/bin/python
+#encoding:utf8
+'''
+Vectorized weighting engine. Loads .tf into CSR sparse blocks and computes
+TF/TFIDF weights and L2 normalisation as whole-array NumPy operations.
+A block is a tuple (docids, indptr, indices, data) where row i holds the
+features indices[indptr[i]:indptr[i+1]] with values data[indptr[i]:indptr[i+1]].
+'''
+from __future__ import with_statement
+import numpy
+from binformat import CSRFile
+
+BLOCK_BYTES = 32 * 1024 * 1024 # bytes of .tf parsed at a time
+MIN_WEIGHT = 1E-5 # tfidf weights not above this are dropped
+
+def read_tf_blocks(path_tf, block_bytes=BLOCK_BYTES, offset=0):
+    '''generator of CSR blocks read from a .tf file, starting at byte offset'''
+    with open(path_tf, 'r') as f:
+        f.seek(offset)
+        while True:
+            lines = f.readlines(block_bytes)
+            if not lines:
+                break
+            lines = [line for line in lines if line.strip()]
+            if lines:
+                yield parse_tf_lines(lines)
+
+def parse_tf_lines(lines):
+    '''parse .tf lines "docid tokenid:tf ..." into a CSR block'''
+    nnz = numpy.array([line.count(':') for line in lines], dtype=numpy.int64)
+    values = numpy.fromstring(''.join(lines).replace(':', ' '), sep=' ')
+    # every row is laid out as docid followed by nnz (tokenid, tf) pairs
+    row_size = 2 * nnz + 1
+    row_start = numpy.cumsum(row_size) - row_size
+    docids = values[row_start].astype(numpy.int64)
+    pairs = numpy.delete(values, row_start).reshape(-1, 2)
+    indptr = numpy.zeros(len(lines) + 1, dtype=numpy.int64)
+    numpy.cumsum(nnz, out=indptr[1:])
+    return docids, indptr, pairs[:, 0].astype(numpy.int64), pairs[:, 1]
+
+def read_df(path_ii):
+    '''read df of every token from .ii, indexed by tokenid; 0 if absent'''
+    tokenids = []
+    dfs = []
+    with open(path_ii, 'r') as f:
+        for line in f:
+            parts = line.split(',', 2)
+            tokenids.append(int(parts[0]))
+            dfs.append(int(parts[1]))
+    df = numpy.zeros(max(tokenids) + 1 if tokenids else 0, dtype=numpy.int64)
+    df[tokenids] = dfs
+    return df
+
+def read_df_binary(path_ii):
+    '''read df of every token from a binary .ii.bin, indexed by tokenid; 0 if absent'''
+    ii = CSRFile(path_ii)
+    df = numpy.zeros(ii.keys.max() + 1 if len(ii) else 0, dtype=numpy.int64)
+    df[ii.keys] = numpy.diff(ii.indptr)
+    ii.close()
+    return df
+
+def idf_vector(df, doc_count):
+    '''log(N/df) per tokenid, NaN for tokens without df'''
+    idf = numpy.empty(len(df), dtype=numpy.float64)
+    idf.fill(numpy.nan)
+    known = df > 0
+    idf[known] = numpy.log(float(doc_count) / df[known])
+    return idf
+
+def _rows(indptr):
+    '''row number of every stored value'''
+    return numpy.repeat(numpy.arange(len(indptr) - 1), numpy.diff(indptr))
+
+def _select(block, keep):
+    '''keep a subset of stored values of a block'''
+    docids, indptr, indices, data = block
+    kept = numpy.zeros(len(indptr), dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(_rows(indptr)[keep], minlength=len(docids)), out=kept[1:])
+    return docids, kept, indices[keep], data[keep]
+
+def _normalize(block, min_weight=None):
+    '''
+    L2 normalize rows and sort features of each row by id. Values whose
+    magnitude is not above min_weight are dropped after the row length is
+    taken; signed hashed features may be negative.
+    '''
+    docids, indptr, indices, data = block
+    rows = _rows(indptr)
+    length = numpy.sqrt(numpy.bincount(rows, weights=data * data, minlength=len(docids)))
+    order = numpy.lexsort((indices, rows))
+    rows = rows[order]
+    with numpy.errstate(divide='ignore', invalid='ignore'): # rows of zero length
+        block = docids, indptr, indices[order], data[order] / length[rows]
+    if min_weight is not None:
+        block = _select(block, numpy.abs(data[order]) > min_weight)
+    return block
+
+def tf_weights(block):
+    '''normalized term frequency'''
+    return _normalize(block)
+
+def tfidf_weights(block, idf):
+    '''normalized tf*idf; tokens without df are ignored, tiny weights dropped'''
+    docids, indptr, indices, data = block
+    word_count = numpy.bincount(_rows(indptr), weights=numpy.abs(data), minlength=len(docids))
+    known = indices < len(idf)
+    known[known] = ~numpy.isnan(idf[indices[known]])
+    docids, indptr, indices, data = _select(block, known)
+    weights = data / word_count[_rows(indptr)] * idf[indices]
+    return _normalize((docids, indptr, indices, weights), MIN_WEIGHT)
+
+def format_rows(block):
+    '''format rows of a block as .wv lines'''
+    docids, indptr, indices, data = block
+    pairs = numpy.empty((len(indices), 2), dtype=object)
+    pairs[:, 0] = indices.tolist()
+    pairs[:, 1] = data.tolist()
+    pairs = pairs.ravel().tolist()
+    formats = {}
+    lines = []
+    bounds = indptr.tolist()
+    for i, docid in enumerate(docids.tolist()):
+        size = bounds[i+1] - bounds[i]
+        if size not in formats:
+            formats[size] = "%d " + " ".join(["%d:%f"] * size) + "\n"
+        lines.append(formats[size] % ((docid,) + tuple(pairs[2*bounds[i]:2*bounds[i+1]])))
+    return lines
+
+def _nonempty(block):
+    '''drop rows without any feature, like empty documents in .tf'''
+    docids, indptr, indices, data = block
+    keep = numpy.diff(indptr) > 0
+    return docids[keep], numpy.concatenate(([0], indptr[1:][keep])), indices, data.astype(numpy.float64)
+
+def weight_blocks(blocks, idf=None):
+    '''generator of weighted blocks, TF weighting if idf is None else TFIDF'''
+    for block in blocks:
+        block = _nonempty(block)
+        if idf is None:
+            yield tf_weights(block)
+        else:
+            yield tfidf_weights(block, idf)
+
+def create_vector(path_tf, path_output, idf=None, offset=0):
+    '''
+    Write .wv from .tf, TF weighting if idf is None else TFIDF. With an
+    offset only the .tf rows from there on are weighted and appended.
+    '''
+    with open(path_output, 'a' if offset else 'w') as fd_output:
+        for block in weight_blocks(read_tf_blocks(path_tf, offset=offset), idf):
+            fd_output.writelines(format_rows(block))